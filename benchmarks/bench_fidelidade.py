@@ -0,0 +1,335 @@
+# Benchmark dos caminhos mais usados da app, com dados sintéticos e um Sheets em memória.
+#
+#   python benchmarks/bench_fidelidade.py --linhas 10000 100000 --saida bench_output.json
+#   python benchmarks/bench_fidelidade.py --comparar bench_anterior.json
+#
+# Os resultados vão para JSON (mediana, mínimo e máximo em ms por operação e tamanho),
+# para comparar versões antes de publicar.
+import argparse
+import json
+import logging
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import types
+import unicodedata
+from datetime import date, datetime
+
+import numpy as np
+import pandas as pd
+from gspread.exceptions import WorksheetNotFound
+from gspread.utils import a1_to_rowcol
+from streamlit.connections import BaseConnection
+from streamlit.runtime.secrets import Secrets
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HOJE = date(2026, 3, 15)
+
+# --- DADOS SINTÉTICOS ---
+NOMES = ["João", "Maria", "Ana", "José", "Inês", "Tiago", "Beatriz", "Rui", "Sofia", "Pedro", "Mariana", "Gonçalo", "Leonor", "Duarte", "Matilde", "Francisco"]
+APELIDOS = ["Silva", "Santos", "Ferreira", "Pereira", "Oliveira", "Costa", "Rodrigues", "Martins", "Jesus", "Sousa", "Fernandes", "Gonçalves", "Conceição", "Lopes"]
+LOCALIDADES = ["Vila Viçosa", "Borba", "Estremoz", "Évora", "Bencatel", "Alandroal", "Redondo"]
+COMIDAS = ["Hambúrguer", "Kebab", "Cachorro", "Bitoque", "Batatas", "Pizza"]
+PREMIOS = {"Dose batatas": 300, "Cachorro 3K": 450, "Hambúrguer Kão Kente": 500, "Kebab de frango": 550}
+
+def sem_acentos(texto):
+    return unicodedata.normalize('NFKD', texto).encode('ascii', 'ignore').decode('ascii').lower()
+
+def gerar_clientes(n, semente=42, historico_medio=12):
+    # Folha de clientes como vem do Sheets: telemóveis numéricos, Historico em texto com as linhas mais recentes primeiro
+    rng = np.random.default_rng(semente)
+    passo = 80_000_000 // n
+    tels = 910_000_000 + rng.permutation(n) * passo + rng.integers(0, passo, n)
+    nomes = rng.choice(NOMES, n)
+    apelidos = rng.choice(APELIDOS, n)
+    emails = [f"{sem_acentos(a)}.{sem_acentos(b)}{k}@gmail.com" for k, (a, b) in enumerate(zip(nomes, apelidos))]
+
+    idades = rng.integers(12, 70, n)
+    nasc = pd.to_datetime(HOJE) - pd.to_timedelta(idades * 365.25 + rng.integers(0, 365, n), unit='D')
+    tipo = np.where(idades < 19, "Estudante", "Normal")
+    # Alguns clientes já com dados antigos, para a manutenção diária ter trabalho
+    desatualizados = rng.random(n) < 0.02
+    tipo[desatualizados & (idades >= 19) & (idades < 23)] = "Estudante"
+    idade_folha = np.where(desatualizados, idades - 1, idades)
+
+    # Historico: compras, alguns resgates e a linha de criação da conta
+    linhas_por_cliente = rng.poisson(historico_medio, n)
+    total = int(linhas_por_cliente.sum())
+    dono = np.repeat(np.arange(n), linhas_por_cliente)
+    datas = pd.Series(pd.to_datetime(HOJE) - pd.to_timedelta(rng.integers(0, 730 * 24 * 60, total), unit='min')).dt.strftime("%d/%m/%Y %H:%M")
+    valores = pd.Series(np.round(rng.uniform(3, 40, total) * 2) / 2)
+    pontos = (valores * np.where(tipo[dono] == "Estudante", 7.5, 5.0)).astype(int)
+    compras = datas + " | Compra " + valores.astype(str) + "€ | +" + pontos.astype(str) + " pts"
+    premio = pd.Series(rng.choice(list(PREMIOS), total))
+    resgates = datas + " | Resgate " + premio + " | -" + premio.map(PREMIOS).astype(str) + " pts"
+    linhas = compras.where(rng.random(total) > 0.1, resgates)
+    criada = pd.Series(pd.to_datetime(HOJE) - pd.to_timedelta(rng.integers(730, 1500, n), unit='D')).dt.strftime("Conta criada em %d/%m/%Y")
+    historico = linhas.groupby(dono).agg("\n".join).reindex(range(n), fill_value="")
+    historico = (historico + "\n" + criada).str.lstrip("\n")
+
+    return pd.DataFrame({
+        "Telemovel": tels, "Nome": nomes, "Apelido": apelidos, "Email": emails,
+        "Pontos": rng.integers(0, 2000, n), "Historico": historico.values,
+        "Password": [f"pw{k:06d}" for k in range(n)], "Tipo": tipo, "Idade": idade_folha,
+        "Nascimento": nasc.strftime("%Y-%m-%d"), "ComidaFavorita": rng.choice(COMIDAS, n),
+        "Localidade": rng.choice(LOCALIDADES, n),
+    })
+
+# --- SHEETS EM MEMÓRIA ---
+# Cada folha é um DataFrame; as chamadas gspread (append_rows, update_cells...) trabalham sobre ele.
+FOLHAS = {}
+CHAMADAS = {"leituras": 0, "escritas": 0}
+
+class CelulaFalsa:
+    def __init__(self, row, col, value=""):
+        self.row, self.col, self.value = row, col, value
+
+class FolhaFalsa:
+    def __init__(self, nome):
+        self.nome = nome
+
+    @property
+    def df(self):
+        return FOLHAS[self.nome]
+
+    def row_values(self, n):
+        CHAMADAS["leituras"] += 1
+        if n == 1: return list(self.df.columns)
+        return [str(v) for v in self.df.iloc[n - 2].tolist()] if n - 2 < len(self.df) else []
+
+    def col_values(self, c):
+        CHAMADAS["leituras"] += 1
+        return [self.df.columns[c - 1]] + self.df.iloc[:, c - 1].astype(str).tolist()
+
+    def batch_get(self, intervalos, major_dimension=None, **kw):
+        # Só intervalos de uma coluna ("C2:C"), como os da leitura projetada
+        CHAMADAS["leituras"] += 1
+        colunas = [a1_to_rowcol(i.split(":")[0])[1] for i in intervalos]
+        return [[self.df.iloc[:, c - 1].astype(str).tolist()] for c in colunas]
+
+    def cell(self, row, col, **kw):
+        CHAMADAS["leituras"] += 1
+        return CelulaFalsa(row, col, str(self.df.iat[row - 2, col - 1]) if row - 2 < len(self.df) else "")
+
+    def find(self, valor, in_column=None):
+        CHAMADAS["leituras"] += 1
+        coluna = self.df.iloc[:, in_column - 1].astype(str).str.replace(r'\.0$', '', regex=True)
+        pos = np.flatnonzero(coluna.values == str(valor))
+        return CelulaFalsa(int(pos[0]) + 2, in_column, valor) if len(pos) else None
+
+    def append_rows(self, linhas, **kw):
+        CHAMADAS["escritas"] += 1
+        novas = pd.DataFrame(linhas, columns=self.df.columns) if len(self.df.columns) else pd.DataFrame(linhas[1:], columns=linhas[0])
+        FOLHAS[self.nome] = pd.concat([self.df, novas], ignore_index=True) if len(self.df) else novas
+
+    def update_cells(self, celulas, **kw):
+        CHAMADAS["escritas"] += 1
+        df = self.df.astype(object)
+        for c in celulas: df.iat[c.row - 2, c.col - 1] = c.value
+        FOLHAS[self.nome] = df
+
+    def delete_rows(self, inicio, fim=None):
+        CHAMADAS["escritas"] += 1
+        FOLHAS[self.nome] = self.df.drop(self.df.index[inicio - 2:(fim or inicio) - 1]).reset_index(drop=True)
+
+    def clear(self):
+        CHAMADAS["escritas"] += 1
+        FOLHAS[self.nome] = pd.DataFrame()
+
+    @property
+    def row_count(self):
+        return len(self.df) + 1
+
+    def add_rows(self, n):
+        pass
+
+    def resize(self, rows=None, cols=None):
+        pass
+
+    def update(self, range_name=None, values=None, **kw):
+        # Só a escrita da folha inteira a partir de A1; as linhas em branco do fim não contam
+        CHAMADAS["escritas"] += 1
+        while values and not any(values[-1]): values = values[:-1]
+        FOLHAS[self.nome] = pd.DataFrame(values[1:], columns=values[0])
+
+    def update_title(self, titulo):
+        FOLHAS[titulo] = FOLHAS.pop(self.nome)
+        self.nome = titulo
+
+class ClienteFalso:
+    # Como no gspread: abrir o livro lê os metadados e procurar a folha lê-os outra vez
+    def _select_worksheet(self, worksheet=None, **kw):
+        self._open_spreadsheet()
+        CHAMADAS["leituras"] += 1
+        if worksheet not in FOLHAS: raise WorksheetNotFound(worksheet)
+        return FolhaFalsa(worksheet)
+
+    def _open_spreadsheet(self, **kw):
+        CHAMADAS["leituras"] += 1
+        return self
+
+    def add_worksheet(self, title, rows=0, cols=0):
+        FOLHAS[title] = pd.DataFrame()
+        return FolhaFalsa(title)
+
+    def del_worksheet(self, folha):
+        FOLHAS.pop(folha.nome)
+
+class GSheetsConnectionFalsa(BaseConnection):
+    def _connect(self, **kw):
+        return ClienteFalso()
+
+    @property
+    def client(self):
+        return self._instance
+
+    def read(self, worksheet="Sheet1", ttl=None, **kw):
+        CHAMADAS["leituras"] += 1
+        if worksheet not in FOLHAS: raise WorksheetNotFound(worksheet)
+        return FOLHAS[worksheet].copy()
+
+    def update(self, worksheet="Sheet1", data=None, **kw):
+        CHAMADAS["escritas"] += 1
+        FOLHAS[worksheet] = data.copy()
+        return data
+
+def importar_app():
+    # A app importa streamlit_gsheets; aqui esse módulo passa a ser o Sheets em memória
+    modulo = types.ModuleType("streamlit_gsheets")
+    modulo.GSheetsConnection = GSheetsConnectionFalsa
+    sys.modules["streamlit_gsheets"] = modulo
+    logging.disable(logging.WARNING)
+    # Sem cópia local do snapshot e com a fila fora da pasta de trabalho: nada fica de uma corrida para a seguinte
+    import streamlit as st
+    segredos = Secrets()
+    segredos._secrets = {"snapshot_local": "", "fila_spool": os.path.join(tempfile.mkdtemp(), "fila.json")}
+    st.secrets = segredos
+    FOLHAS["Sheet1"] = pd.DataFrame()
+    sys.path.insert(0, RAIZ)
+    import fidelidade
+    return fidelidade
+
+# --- MEDIÇÃO ---
+def medir(funcao, repeticoes, preparar=None):
+    tempos = []
+    for _ in range(repeticoes):
+        args = preparar() if preparar else ()
+        t0 = time.perf_counter()
+        funcao(*args)
+        tempos.append((time.perf_counter() - t0) * 1000)
+    return {"mediana_ms": round(statistics.median(tempos), 3), "min_ms": round(min(tempos), 3), "max_ms": round(max(tempos), 3), "repeticoes": repeticoes}
+
+def correr(app, n, repeticoes, semente):
+    import streamlit as st
+    import nucleo
+    st.cache_resource.clear()
+    FOLHAS.clear()
+    FOLHAS["Sheet1"] = gerar_clientes(n, semente)
+    rng = np.random.default_rng(semente + 1)
+    snap = app.obter_snapshot()
+    snap.manutencao_em = date.today()   # sem a thread de manutenção a meio das medições
+    r = {}
+
+    def frio():
+        snap.invalidar()
+        return ()
+    r["load_data_frio"] = medir(app.load_data, repeticoes, frio)
+    r["load_data_quente"] = medir(app.load_data, repeticoes)
+    # Login: só as colunas das contas, com o snapshot completo por ler. O read falso não tem rede nem
+    # parsing, por isso fica também a fração dos bytes das células que a leitura projetada traz.
+    r["load_contas_frio"] = medir(app.load_contas, repeticoes, frio)
+    bytes_coluna = FOLHAS["Sheet1"].astype(str).apply(lambda c: c.str.len().sum())
+    r["load_contas_frio"]["fracao_bytes"] = round(float(bytes_coluna[app.COLUNAS_CONTA].sum() / bytes_coluna.sum()), 3)
+    df = app.load_data()
+
+    r["verificar_atualizacoes_automaticas"] = medir(lambda d: nucleo.verificar_atualizacoes_automaticas(d, HOJE), repeticoes, lambda: (df.copy(),))
+
+    # Login: índice construído uma vez por versão do snapshot, depois 1000 procuras (metade por e-mail)
+    def novo_indice():
+        snap.alterado()
+        return (app.load_data(),)
+    r["indice_construir"] = medir(app.obter_indice, repeticoes, novo_indice)
+    df = app.load_data()
+    indice = app.obter_indice(df)
+    amostra = rng.choice(len(df), 1000)
+    tels, emails, pws = df['Telemovel'].values[amostra], df['Email'].values[amostra], df['Password'].values[amostra]
+    def login():
+        for k in range(len(amostra)):
+            chave = tels[k] if k % 2 else emails[k]
+            for idx in (indice.linha_telemovel(chave), indice.linha_email(chave)):
+                if idx is not None and df.at[idx, 'Password'] == pws[k]: break
+    r["login_1000"] = medir(login, repeticoes)
+
+    # Registo: o número e o e-mail novos não podem existir
+    def duplicados():
+        for k in range(1000):
+            indice.linha_telemovel(f"99{k:07d}") is None and indice.linha_email(f"novo{k}@gmail.com") is None
+    r["registo_duplicados_1000"] = medir(duplicados, repeticoes)
+
+    # Métricas do cliente: a primeira chamada converte o Historico para o livro de movimentos
+    t0 = time.perf_counter()
+    livro = app.carregar_movimentos()
+    r["migrar_historico"] = {"mediana_ms": round((time.perf_counter() - t0) * 1000, 3), "repeticoes": 1, "movimentos": len(livro.df)}
+    def livro_alterado():
+        livro.versao += 1
+        return ()
+    r["livro_indices"] = medir(livro.indices, repeticoes, livro_alterado)
+    livro.indices()
+    def metricas():
+        for t in tels[:1000]: app.calcular_metricas(livro.movimentos(t), HOJE)
+    r["calcular_metricas_1000"] = medir(metricas, repeticoes)
+
+    CHAMADAS.update(leituras=0, escritas=0)
+    r["save_data"] = medir(app.save_data, repeticoes, lambda: (app.load_data(),))
+    r["save_data"]["escritas_por_chamada"] = CHAMADAS["escritas"] / repeticoes
+    return r
+
+def comparar(atual, anterior, tolerancia):
+    # Devolve as operações que ficaram mais lentas do que a tolerância (por exemplo 1.25 = +25%)
+    piores = []
+    for n, ops in atual["resultados"].items():
+        for op, m in ops.items():
+            antes = anterior.get("resultados", {}).get(n, {}).get(op)
+            if not antes or not antes.get("mediana_ms"): continue
+            razao = m["mediana_ms"] / antes["mediana_ms"]
+            print(f"{n:>8} {op:<36} {antes['mediana_ms']:>10.2f} → {m['mediana_ms']:>10.2f} ms  ({razao:.2f}x)")
+            if razao > tolerancia: piores.append((n, op, razao))
+    return piores
+
+def main():
+    p = argparse.ArgumentParser(description="Benchmark da app de fidelização com dados sintéticos")
+    p.add_argument("--linhas", type=int, nargs="+", default=[10_000, 100_000], help="tamanhos da folha de clientes (ex.: 10000 100000 1000000)")
+    p.add_argument("--repeticoes", type=int, default=5)
+    p.add_argument("--semente", type=int, default=42)
+    p.add_argument("--saida", default="bench_output.json")
+    p.add_argument("--comparar", help="JSON de uma execução anterior; sai com erro se alguma operação piorar")
+    p.add_argument("--tolerancia", type=float, default=1.25)
+    a = p.parse_args()
+
+    app = importar_app()
+    resultado = {
+        "data": datetime.now().isoformat(timespec="seconds"), "python": platform.python_version(),
+        "pandas": pd.__version__, "semente": a.semente, "resultados": {}
+    }
+    for n in a.linhas:
+        print(f"{n} clientes...", flush=True)
+        resultado["resultados"][str(n)] = correr(app, n, a.repeticoes, a.semente)
+        for op, m in resultado["resultados"][str(n)].items():
+            print(f"  {op:<36} {m['mediana_ms']:>10.2f} ms")
+
+    with open(a.saida, "w", encoding="utf-8") as f:
+        json.dump(resultado, f, indent=2, ensure_ascii=False)
+    print(f"Resultados em {a.saida}")
+
+    if a.comparar:
+        with open(a.comparar, encoding="utf-8") as f:
+            piores = comparar(resultado, json.load(f), a.tolerancia)
+        if piores:
+            print(f"{len(piores)} operações pioraram mais de {a.tolerancia:.2f}x")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
@@ -0,0 +1,219 @@
+# Teste de carga: várias sessões em paralelo a correr as páginas reais (AppTest) contra o Sheets em memória.
+#
+#   python benchmarks/carga_sessoes.py --sessoes 1 5 10 20 --fluxos 5 --linhas 5000
+#
+# Fluxos: cliente (home → login → pontos), balcão (pesquisa → Lançar → Resgatar) e registo.
+# Mede cada rerun (percentis p50/p95/p99), o débito (reruns e fluxos por segundo) e as leituras e
+# escritas ao Sheets por fluxo (numa passagem isolada, uma sessão de cada vez).
+import argparse
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+import types
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+from streamlit.runtime import Runtime
+from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+from streamlit.runtime.secrets import Secrets
+from streamlit.testing.v1 import AppTest, local_script_runner
+
+from bench_fidelidade import CHAMADAS, FOLHAS, GSheetsConnectionFalsa, gerar_clientes
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT = os.path.join(RAIZ, "fidelidade.py")
+PASSWORD_ADMIN = "carga"
+PESQUISAS = ["silva", "maria", "costa", "ines", "rui", "santos", "ana", "joao"]
+
+# --- SESSÕES ---
+class Sessao:
+    # Uma visita: um AppTest novo (como um telemóvel ou uma caixa a abrir a app)
+    def __init__(self, timeout):
+        self.at = AppTest.from_file(SCRIPT, default_timeout=timeout)
+        self.tempos = []
+        self.erros = 0
+
+    def run(self, passo):
+        t0 = time.perf_counter()
+        self.at.run()
+        self.tempos.append((passo, (time.perf_counter() - t0) * 1000))
+        if self.at.exception: self.erros += 1
+
+    def widget(self, tipo, rotulo):
+        for w in getattr(self.at, tipo):
+            if w.label == rotulo: return w
+        raise LookupError(f"{tipo} '{rotulo}' não está na página {self.at.session_state['pagina']}")
+
+    def carregar(self, rotulo, passo):
+        self.widget("button", rotulo).click()
+        self.run(passo)
+
+def fluxo_cliente(s, rng, clientes):
+    k = rng.integers(len(clientes))
+    s.run("home")
+    s.carregar("👤 ENTRAR OU CRIAR CONTA", "abrir_login")
+    s.widget("text_input", "Telemóvel ou e-mail").input(str(clientes['Telemovel'].iat[k]))
+    s.widget("text_input", "Palavra-passe").input(clientes['Password'].iat[k])
+    s.carregar("ENTRAR", "login")
+    s.carregar("🏆 OS MEUS PONTOS", "pontos")
+
+def fluxo_balcao(s, rng, clientes):
+    s.at.session_state['pagina'] = "admin_login"
+    s.run("admin_login")
+    s.widget("text_input", "Password").input(PASSWORD_ADMIN)
+    s.run("admin_entrar")
+    s.widget("text_input", "🔍 Pesquisar").input(str(rng.choice(PESQUISAS)))
+    s.run("pesquisa")
+    s.widget("number_input", "Valor €").set_value(float(rng.integers(3, 40)))
+    s.carregar("Lançar", "lancar")
+    s.carregar("Resgatar", "resgatar")
+
+def fluxo_registo(s, rng, clientes):
+    tel = f"93{rng.integers(0, 10_000_000):07d}"
+    s.at.session_state['pagina'] = "login_menu"
+    s.run("abrir_registo")
+    s.widget("text_input", "Nome próprio").input("Carga")
+    s.widget("text_input", "Apelido").input("Teste")
+    s.widget("text_input", "Número de telemóvel").input(tel)
+    s.widget("text_input", "E-mail").input(f"carga{tel}@exemplo.pt")
+    s.at.text_input(key="p1").input("pw")
+    s.at.text_input(key="p2").input("pw")
+    s.carregar("CRIAR CONTA", "registo")
+
+FLUXOS = {"cliente": fluxo_cliente, "balcao": fluxo_balcao, "registo": fluxo_registo}
+
+def partilhar_runtime(tmp):
+    # O AppTest foi feito para uma sessão por processo: põe o Runtime falso no início de cada run e apaga-o
+    # no fim, troca st.secrets e compila o script de cada vez. Com sessões em threads, uma apagava o runtime
+    # ou os secrets de outra a meio. Aqui ficam partilhados, como num servidor: um runtime, uma cache do
+    # script compilado e os mesmos secrets para todas.
+    segredos = Secrets()
+    segredos._secrets = {"admin_password": PASSWORD_ADMIN, "snapshot_local": os.path.join(tmp, "snapshot.arrow"),
+                         "fila_spool": os.path.join(tmp, "fila.json")}
+    st.secrets = segredos
+    cache = ScriptCache()
+    local_script_runner.ScriptCache = lambda: cache
+    ultimo = {}
+    def instance(cls):
+        if cls._instance is not None: ultimo['r'] = cls._instance
+        if 'r' not in ultimo: raise RuntimeError("Runtime hasn't been created!")
+        return ultimo['r']
+    Runtime.instance = classmethod(instance)
+    Runtime.exists = classmethod(lambda cls: cls._instance is not None or 'r' in ultimo)
+
+# --- MEDIÇÃO ---
+def percentis(tempos):
+    if not tempos: return {}
+    t = np.array(tempos)
+    return {"p50_ms": round(float(np.percentile(t, 50)), 1), "p95_ms": round(float(np.percentile(t, 95)), 1),
+            "p99_ms": round(float(np.percentile(t, 99)), 1), "max_ms": round(float(t.max()), 1), "n": len(t)}
+
+def instalar_sheets(n, semente):
+    modulo = types.ModuleType("streamlit_gsheets")
+    modulo.GSheetsConnection = GSheetsConnectionFalsa
+    sys.modules["streamlit_gsheets"] = modulo
+    logging.disable(logging.WARNING)
+    FOLHAS.clear()
+    FOLHAS["Sheet1"] = gerar_clientes(n, semente)
+    return FOLHAS["Sheet1"][['Telemovel', 'Password']].copy()
+
+def isolado(clientes, timeout, semente, espera_fila):
+    # Leituras e escritas de um fluxo sozinho, já com a app quente; a fila de escrita é esperada
+    rng = np.random.default_rng(semente)
+    contas = {}
+    for nome, fluxo in FLUXOS.items():
+        CHAMADAS.update(leituras=0, escritas=0)
+        s = Sessao(timeout)
+        fluxo(s, rng, clientes)
+        time.sleep(espera_fila)
+        contas[nome] = {"leituras": CHAMADAS["leituras"], "escritas": CHAMADAS["escritas"], "reruns": len(s.tempos), "erros": s.erros}
+    return contas
+
+def concorrente(clientes, sessoes, fluxos, mistura, timeout, semente):
+    nomes, pesos = zip(*mistura.items())
+    pesos = np.array(pesos, dtype=float) / sum(pesos)
+    tempos, feitos, falhas = [], {n: 0 for n in nomes}, []
+    lock = threading.Lock()
+
+    def trabalhador(k):
+        rng = np.random.default_rng(semente + k)
+        for _ in range(fluxos):
+            nome = nomes[rng.choice(len(nomes), p=pesos)]
+            s = Sessao(timeout)
+            try:
+                FLUXOS[nome](s, rng, clientes)
+            except Exception as e:
+                with lock: falhas.append(f"{nome}: {type(e).__name__}: {e}")
+            with lock:
+                tempos.extend(s.tempos)
+                feitos[nome] += 1
+                if s.erros: falhas.append(f"{nome}: {s.erros} exceções na página")
+
+    CHAMADAS.update(leituras=0, escritas=0)
+    t0 = time.perf_counter()
+    threads = [threading.Thread(target=trabalhador, args=(k,)) for k in range(sessoes)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    duracao = time.perf_counter() - t0
+
+    por_passo = {}
+    for passo, ms in tempos: por_passo.setdefault(passo, []).append(ms)
+    total = sum(feitos.values())
+    return {
+        "duracao_s": round(duracao, 2), "fluxos": feitos, "falhas": falhas[:20], "n_falhas": len(falhas),
+        "reruns_por_s": round(len(tempos) / duracao, 2), "fluxos_por_s": round(total / duracao, 2),
+        "leituras_por_fluxo": round(CHAMADAS["leituras"] / max(total, 1), 2), "escritas_por_fluxo": round(CHAMADAS["escritas"] / max(total, 1), 2),
+        "rerun": percentis([ms for _, ms in tempos]), "por_passo": {p: percentis(t) for p, t in sorted(por_passo.items())},
+    }
+
+def ler_mistura(texto):
+    mistura = {}
+    for parte in texto.split(","):
+        nome, peso = parte.split("=")
+        if nome not in FLUXOS: raise SystemExit(f"Fluxo desconhecido: {nome} (há {', '.join(FLUXOS)})")
+        mistura[nome] = float(peso)
+    return mistura
+
+def main():
+    p = argparse.ArgumentParser(description="Teste de carga com sessões AppTest em paralelo")
+    p.add_argument("--sessoes", type=int, nargs="+", default=[1, 5, 10], help="sessões em paralelo (uma medição por valor)")
+    p.add_argument("--fluxos", type=int, default=5, help="fluxos seguidos por sessão")
+    p.add_argument("--linhas", type=int, default=5000, help="clientes na folha")
+    p.add_argument("--mistura", default="cliente=6,balcao=3,registo=1", help="peso de cada fluxo")
+    p.add_argument("--semente", type=int, default=42)
+    p.add_argument("--timeout", type=float, default=60, help="segundos máximos por rerun")
+    p.add_argument("--espera-fila", type=float, default=6.0, help="segundos à espera da fila de escrita na passagem isolada")
+    p.add_argument("--saida", default="carga_output.json")
+    a = p.parse_args()
+
+    mistura = ler_mistura(a.mistura)
+    clientes = instalar_sheets(a.linhas, a.semente)
+    resultado = {
+        "data": datetime.now().isoformat(timespec="seconds"), "python": platform.python_version(), "pandas": pd.__version__,
+        "linhas": a.linhas, "fluxos_por_sessao": a.fluxos, "mistura": mistura, "semente": a.semente, "resultados": {}
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        partilhar_runtime(tmp)
+        print("Passagem isolada (leituras/escritas por fluxo)...", flush=True)
+        resultado["por_fluxo"] = isolado(clientes, a.timeout, a.semente, a.espera_fila)
+        for nome, c in resultado["por_fluxo"].items():
+            print(f"  {nome:<8} {c['reruns']} reruns · {c['leituras']} leituras · {c['escritas']} escritas" + (f" · {c['erros']} erros" if c['erros'] else ""))
+        for n in a.sessoes:
+            print(f"{n} sessões em paralelo...", flush=True)
+            r = resultado["resultados"][str(n)] = concorrente(clientes, n, a.fluxos, mistura, a.timeout, a.semente)
+            print(f"  rerun p50 {r['rerun'].get('p50_ms')} ms · p95 {r['rerun'].get('p95_ms')} ms · p99 {r['rerun'].get('p99_ms')} ms"
+                  f" · {r['reruns_por_s']} reruns/s · {r['fluxos_por_s']} fluxos/s · {r['n_falhas']} falhas")
+
+    with open(a.saida, "w", encoding="utf-8") as f:
+        json.dump(resultado, f, indent=2, ensure_ascii=False)
+    print(f"Resultados em {a.saida}")
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
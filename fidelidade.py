@@ -1,13 +1,29 @@
 import streamlit as st
 import pandas as pd
 import math
+import os
+import re
 import base64
+import functools
+import json
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager, nullcontext
 from datetime import datetime, date
 from streamlit_gsheets import GSheetsConnection
 import streamlit.components.v1 as components
+from nucleo import (
+    COLUNAS_CLIENTES, COLUNAS_CONTA, COLUNAS_EXPORTACAO, COLUNAS_MOVIMENTOS, FORMATO_DATA_MOVIMENTO, PREMIOS_PONTOS,
+    ArmazenamentoSheets, ArmazenamentoSQLite, IndiceClientes, LeiturasPartilhadas, SaldoInsuficiente, alteracoes_manutencao, calcular_idade, calcular_metricas, calcular_pontos_ganhos, calcular_resumo, converter_historico, erro_quota,
+    exportar_csv, filtrar_tabela, ler_exportacao_caixa, movimentos_importacao, normalizar_clientes, normalizar_movimentos,
+    normalizar_telemovel, novo_movimento, preparar_importacao, resumir_movimentos, somar_pontos, valor_celula
+)
 
 # --- CONFIGURAÇÃO INICIAL ---
-st.set_page_config(page_title="Kão Kente", page_icon="logo.png", layout="wide")
+LOGO_ESTATICO = "static/logo.png"
+st.set_page_config(page_title="Kão Kente", page_icon=LOGO_ESTATICO if os.path.exists(LOGO_ESTATICO) else "logo.png", layout="wide")
 
 # --- CORES DA MARCA ---
 COR_FUNDO = "#946128"
@@ -24,6 +40,7 @@ if "menu" in st.query_params and st.query_params["menu"] == "gest":
         st.session_state['pagina'] = 'admin_login'
 
 # --- FUNÇÃO IMAGEM ---
+@st.cache_resource
 def get_image_base64(path):
     try:
         with open(path, "rb") as image_file:
@@ -32,10 +49,21 @@ def get_image_base64(path):
     except:
         return "" 
 
-logo_b64 = get_image_base64("logo.png")
+@st.cache_resource
+def obter_logo_src():
+    # Logo de 320px (160px em ecrãs 2x) servido pelo static serving: o browser guarda-o em cache.
+    # Sem static serving, vai em base64, codificado uma vez por processo.
+    if st.get_option("server.enableStaticServing") and os.path.exists(LOGO_ESTATICO):
+        return "app/static/logo.png"
+    return get_image_base64(LOGO_ESTATICO if os.path.exists(LOGO_ESTATICO) else "logo.png")
+
+logo_src = obter_logo_src()
 
 # --- CSS (CORREÇÃO DE DROPDOWNS E BOTÕES) ---
-st.markdown(f"""
+@st.cache_resource
+def css_global():
+    # Montado e compactado uma vez por processo (sem comentários nem espaços a mais)
+    css = f"""
     <style>
     /* Ajuste do contentor principal */
     .block-container {{
@@ -164,28 +192,223 @@ st.markdown(f"""
     }}
     .saldo-card div {{ color: {COR_CASTANHO} !important; }}
     
+    /* Cartões dos prémios (a largura da barra é o único estilo em linha) */
+    .premio-card {{
+        background-color: white;
+        border-radius: 15px;
+        padding: 15px;
+        margin-bottom: 15px;
+        box-shadow: 0 2px 4px rgba(0,0,0,0.1);
+    }}
+    .premio-topo {{ display: flex; justify-content: space-between; align-items: center; margin-bottom: 5px; }}
+    .premio-nome {{ font-weight: bold; color: {COR_CASTANHO}; font-size: 1.1em; }}
+    .premio-icone {{ font-size: 1.5em; }}
+    .premio-pts {{ color: #666; font-size: 0.9em; margin-bottom: 8px; text-align: left; }}
+    .premio-barra {{ width: 100%; background-color: #eee; border-radius: 10px; height: 12px; overflow: hidden; }}
+    .premio-barra div {{ background-color: {COR_BOTAO_FUNDO}; height: 100%; border-radius: 10px; transition: width 0.5s; }}
+    .premio-barra div.completo {{ background-color: {COR_VERDE_ESCURO}; }}
+    
+    /* Separadores (login e painel) */
+    .stTabs [data-baseweb="tab-list"] button {{ color: white !important; }}
+    
     /* Imagens */
     div[data-testid="stImage"] {{
         display: flex;
         justify-content: center;
     }}
     </style>
-""", unsafe_allow_html=True)
+"""
+    css = re.sub(r'/\*.*?\*/', '', css, flags=re.S)
+    css = re.sub(r'\s*([{};:,>])\s*', r'\1', css)
+    return re.sub(r'\s+', ' ', css).strip()
+
+st.markdown(css_global(), unsafe_allow_html=True)
 
 # --- LIGAÇÃO ---
 conn = st.connection("gsheets", type=GSheetsConnection)
 
-PREMIOS_PONTOS = {
-    "Dose batatas": 300,
-    "Cachorro 3K": 450,
-    "Hambúrguer Kão Kente": 500,
-    "Kebab de frango": 550,
-    "Baconcheeseburger com ovo": 700,
-    "Bitoque de frango": 950
-}
 URL_ENCOMENDAS = "https://www.foodbooking.com/ordering/restaurant/menu?company_uid=e92e9690-8f0b-45e2-acca-6671a872abb9&restaurant_uid=5e09158f-4dc1-4b17-b9d5-687ca8510db8&facebook=true"
 URL_LINKTREE = "https://linktr.ee/KaoKente"
 
+def ler_config(chave, padrao=None):
+    try:
+        return st.secrets.get(chave, padrao)
+    except Exception:
+        return padrao
+
+# --- DIAGNÓSTICO (TEMPOS POR EXECUÇÃO) ---
+# Cada execução do script (e cada envio da fila ou manutenção) fica registada: tempo total, chamadas ao
+# armazenamento com tempo e linhas, pedidos HTTP ao Google e bytes recebidos. Guarda as últimas N.
+JANELA_DIAGNOSTICO = int(ler_config("janela_diagnostico", 500))
+LOG_DIAGNOSTICO = bool(ler_config("diagnostico_log", False))
+log_diagnostico = logging.getLogger("kaokente.diagnostico")
+
+class Diagnostico:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.execucoes = deque(maxlen=JANELA_DIAGNOSTICO)
+        self.local = threading.local()
+
+    @contextmanager
+    def execucao(self, nome):
+        # Dentro de outra execução da mesma thread, as chamadas contam para a de fora
+        if getattr(self.local, 'atual', None) is not None:
+            yield
+            return
+        atual = self.local.atual = {
+            "data": datetime.now().isoformat(timespec="seconds"), "execucao": nome, "ms": 0.0, "erro": False,
+            "api": 0, "bytes": 0, "linhas_lidas": 0, "linhas_escritas": 0, "ops": []
+        }
+        t0 = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            atual["erro"] = True
+            raise
+        finally:
+            atual["ms"] = round((time.perf_counter() - t0) * 1000, 2)
+            self.local.atual = None
+            with self.lock: self.execucoes.append(atual)
+            if LOG_DIAGNOSTICO: log_diagnostico.info(json.dumps(atual, ensure_ascii=False))
+
+    def op(self, nome, ms, lidas=0, escritas=0):
+        atual = getattr(self.local, 'atual', None)
+        if atual is None: return
+        atual["ops"].append([nome, round(ms, 2)])
+        atual["linhas_lidas"] += lidas
+        atual["linhas_escritas"] += escritas
+
+    def http(self, resposta, *args, **kwargs):
+        # Hook de resposta da sessão requests do gspread
+        atual = getattr(self.local, 'atual', None)
+        if atual is None: return
+        atual["api"] += 1
+        atual["bytes"] += len(resposta.content or b"")
+
+    def registos(self):
+        with self.lock:
+            return list(self.execucoes)
+
+@st.cache_resource
+def obter_diagnostico():
+    return Diagnostico()
+
+def medido(nome):
+    def decorador(funcao):
+        @functools.wraps(funcao)
+        def medida(*args, **kwargs):
+            t0 = time.perf_counter()
+            try:
+                return funcao(*args, **kwargs)
+            finally:
+                obter_diagnostico().op(nome, (time.perf_counter() - t0) * 1000)
+        return medida
+    return decorador
+
+def percentis_diagnostico(registos):
+    # p50/p95/p99 por página (tempo total da execução) e por operação (tempo de cada chamada)
+    if not registos: return None, None
+    ex = pd.DataFrame(registos)
+    por_execucao = ex.groupby('execucao').agg(
+        n=('ms', 'size'), p50=('ms', lambda x: x.quantile(.5)), p95=('ms', lambda x: x.quantile(.95)), p99=('ms', lambda x: x.quantile(.99)),
+        api=('api', 'mean'), kb=('bytes', lambda x: x.mean() / 1024), lidas=('linhas_lidas', 'mean'), escritas=('linhas_escritas', 'mean'), erros=('erro', 'sum'))
+    ops = pd.DataFrame([op for r in registos for op in r['ops']], columns=['op', 'ms'])
+    por_op = ops.groupby('op')['ms'].describe(percentiles=[.5, .95, .99])[['count', '50%', '95%', '99%']] if len(ops) else None
+    return por_execucao.round(1), (por_op.round(1) if por_op is not None else None)
+
+# --- CACHE PARTILHADA DE CLIENTES ---
+# Um único snapshot normalizado por processo, partilhado por todas as sessões.
+CACHE_TTL_SEGUNDOS = float(ler_config("cache_ttl_segundos", 30))
+
+class SnapshotClientes:
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.df = None
+        self.versao = 0
+        self.carregado_em = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.indice = None
+        self.manutencao_em = None
+        self.relatorio_manutencao = None
+        self.relatorio_compactacao = None
+        # Projeção só com as colunas de conta e saldo: [versão do snapshot, carregado_em, df, índice]
+        self.contas = None
+        self.leituras_contas = 0
+        # local: o snapshot é a cópia local (Sheets em baixo ou ainda a arrancar), só para leitura
+        self.local = False
+        self.lido_em = None
+        self.arrancou = False
+        # Há uma leitura da folha em curso (fora do lock): quem tem uma cópia, mesmo antiga, não espera por ela
+        self.lendo = False
+
+    def fresco(self):
+        return self.df is not None and (time.monotonic() - self.carregado_em) < CACHE_TTL_SEGUNDOS
+
+    def contas_frescas(self):
+        return self.contas is not None and self.contas[0] == self.versao and (time.monotonic() - self.contas[1]) < CACHE_TTL_SEGUNDOS
+
+    def guardar(self, df, local=False):
+        self.df = df
+        self.versao += 1
+        self.carregado_em = time.monotonic()
+        self.local = local
+
+    def alterado(self):
+        # Alteração local já escrita na folha: nova versão sem renovar a validade
+        self.versao += 1
+
+    def invalidar(self):
+        # Nova versão: uma leitura que já estava em curso não é guardada por cima disto
+        self.df = None
+        self.contas = None
+        self.versao += 1
+
+    def copia(self):
+        df = self.df.copy()
+        df.attrs['versao'] = self.versao
+        return df
+
+    def indice_atual(self):
+        if self.indice is None or self.indice.versao != self.versao:
+            self.indice = IndiceClientes(self.df, self.versao)
+        return self.indice
+
+    def copia_contas(self):
+        # Do snapshot completo: a mesma versão, por isso o mesmo índice
+        df = self.df[COLUNAS_CONTA].copy()
+        df.attrs['versao'] = self.versao
+        return df
+
+    def guardar_contas(self, df):
+        # Cada leitura projetada tem versão própria, que nunca se confunde com a do snapshot completo
+        self.leituras_contas += 1
+        df.attrs['versao'] = ("contas", self.leituras_contas)
+        self.contas = [self.versao, time.monotonic(), df, None]
+
+    def indice_contas(self):
+        # Construído uma vez por leitura projetada (o login não volta a ordenar os nomes a cada clique)
+        if self.contas[3] is None: self.contas[3] = IndiceClientes(self.contas[2], self.contas[2].attrs['versao'])
+        return self.contas[3]
+
+@st.cache_resource
+def obter_snapshot():
+    return SnapshotClientes()
+
+# --- ÍNDICE DE CLIENTES (TELEMÓVEL / EMAIL → LINHA) ---
+RESULTADOS_POR_PAGINA = 20
+
+def obter_indice(df):
+    # Construído uma vez por versão do snapshot (ou da projeção das contas); um df de outra versão tem índice próprio
+    snap = obter_snapshot()
+    versao = df.attrs.get('versao')
+    with snap.lock:
+        if versao is not None and versao == snap.versao and snap.df is not None:
+            return snap.indice_atual()
+        if versao is not None and snap.contas is not None and versao == snap.contas[2].attrs['versao']:
+            return snap.indice_contas()
+    return IndiceClientes(df, versao)
+
 # --- NAVEGAÇÃO ---
 if 'pagina' not in st.session_state: st.session_state['pagina'] = "home"
 if 'user_logado' not in st.session_state: st.session_state['user_logado'] = None
@@ -195,96 +418,909 @@ def navegar(destino):
     st.session_state['pagina'] = destino
     st.rerun()
 
-# --- LÓGICA DE NEGÓCIO ---
-def calcular_idade(data_nascimento):
-    if not data_nascimento: return 0
-    if isinstance(data_nascimento, str):
-        try:
-            data_nascimento = datetime.strptime(data_nascimento, "%Y-%m-%d").date()
-        except:
-            return 0
-    hoje = date.today()
-    return hoje.year - data_nascimento.year - ((hoje.month, hoje.day) < (data_nascimento.month, data_nascimento.day))
-
-def calcular_pontos_ganhos(valor, tipo):
-    mult = 7.5 if tipo == "Estudante" else 5.0
-    return int(int(valor) * mult)
-
-def calcular_metricas(hist_str):
-    agora = datetime.now()
-    mes, ano = agora.month, agora.year
-    mes_ant = 12 if mes == 1 else mes - 1
-    ano_ant = ano - 1 if mes == 1 else ano
-    curr, prev = 0.0, 0.0
-    if not isinstance(hist_str, str): return 0.0, 0.0
-    for linha in hist_str.split('\n'):
-        if "Compra" in linha:
-            try:
-                pt = linha.split('|')
-                val = float(pt[1].replace("Compra", "").replace("€", "").strip())
-                dt_str = pt[0].strip()
-                try: dt = datetime.strptime(dt_str, '%d/%m/%Y %H:%M')
-                except: dt = datetime.strptime(dt_str, '%d/%m %H:%M').replace(year=ano)
-                if dt.month == mes and dt.year == ano: curr += val
-                elif dt.month == mes_ant and dt.year == ano_ant: prev += val
-            except: continue
-    return curr, prev
-
-# --- FUNÇÃO DE ATUALIZAÇÃO AUTOMÁTICA DE IDADE E TIPO ---
-def verificar_atualizacoes_automaticas(df):
-    mudou = False
-    for index, row in df.iterrows():
-        nasc_str = str(row['Nascimento'])
-        if nasc_str and nasc_str != 'nan' and nasc_str != '':
+# --- LOJAS (CADA LOJA LÊ SÓ A SUA PARTIÇÃO) ---
+# st.secrets: loja = "<nome>" e uma secção [lojas.<nome>] por loja com as folhas (clientes, movimentos,
+# arquivo) ou o sqlite_caminho. O que não estiver configurado usa as folhas de sempre.
+LOJA = ler_config("loja", "principal")
+LOJAS = {nome: dict(cfg) for nome, cfg in dict(ler_config("lojas", {}) or {}).items()}
+
+def config_loja(loja, chave, padrao):
+    return LOJAS.get(loja, {}).get(chave, padrao)
+
+# --- LEITURAS DO SHEETS (UMA SÓ EM VOO, NOVAS TENTATIVAS NA QUOTA) ---
+# Leituras iguais ao mesmo tempo (várias sessões) partilham um só pedido. Um 429 volta a ser tentado
+# com espera exponencial e uma parte aleatória, para os terminais não repetirem todos no mesmo instante.
+LEITURA_TENTATIVAS = int(ler_config("leitura_tentativas", 4))
+LEITURA_ESPERA_BASE = float(ler_config("leitura_espera_base", 1.0))
+
+@st.cache_resource
+def obter_leituras():
+    return LeiturasPartilhadas(LEITURA_TENTATIVAS, LEITURA_ESPERA_BASE)
+
+# --- ARMAZENAMENTO (GOOGLE SHEETS OU SQLITE LOCAL, MOTORES EM nucleo.py) ---
+class ArmazenamentoMedido:
+    # Envolve um motor e regista no diagnóstico o tempo e as linhas de cada chamada
+    ESCRITAS_EM_LOTE = {"atualizar_campos": 0, "reescrever_clientes": 0, "acrescentar_movimentos": 0, "reescrever_movimentos": 0, "renomear_movimentos": 2, "acrescentar_arquivo": 0}
+
+    def __init__(self, motor):
+        self.motor = motor
+
+    def __getattr__(self, nome):
+        valor = getattr(self.motor, nome)
+        if not callable(valor) or nome.startswith("_"): return valor
+        
+        def medida(*args, **kwargs):
+            t0 = time.perf_counter()
+            r = None
             try:
-                data_nasc = datetime.strptime(nasc_str, "%Y-%m-%d").date()
-                nova_idade = calcular_idade(data_nasc)
-                
-                # Atualiza Idade
-                if int(row['Idade']) != nova_idade:
-                    df.at[index, 'Idade'] = nova_idade
-                    mudou = True
-                
-                # Se passou dos 19 anos, deixa de ser estudante
-                if row['Tipo'] == 'Estudante' and nova_idade > 19:
-                    df.at[index, 'Tipo'] = 'Normal'
-                    df.at[index, 'Historico'] = f"{datetime.now().strftime('%d/%m/%Y')} | Sistema: Mudou para Normal (>19 anos)\n" + str(row['Historico'])
-                    mudou = True
-            except:
-                pass
-    return df, mudou
+                r = valor(*args, **kwargs)
+                return r
+            finally:
+                lidas = escritas = 0
+                if nome.startswith(("ler_", "obter_")):
+                    lidas = len(r) if isinstance(r, pd.DataFrame) else int(r is not None)
+                elif nome in self.ESCRITAS_EM_LOTE:
+                    escritas = len(args[self.ESCRITAS_EM_LOTE[nome]])
+                else:
+                    escritas = 1
+                obter_diagnostico().op(f"{self.motor.nome}.{nome}", (time.perf_counter() - t0) * 1000, lidas, escritas)
+        return medida
 
-def load_data():
+def _contar_http(ligacao):
+    # Só a ligação com Service Account usa uma sessão requests (a pública lê CSV diretamente)
     try:
-        df = conn.read(worksheet="Sheet1", ttl=0)
-        if df is None or df.empty: 
-            return pd.DataFrame(columns=["Telemovel", "Nome", "Apelido", "Email", "Pontos", "Historico", "Password", "Tipo", "Idade", "Nascimento", "ComidaFavorita", "Localidade"])
-        
-        df['Telemovel'] = df['Telemovel'].astype(str).replace('nan', '').str.replace(r'\.0$', '', regex=True)
-        cols_str = ['Nome', 'Apelido', 'Email', 'Historico', 'Password', 'Tipo', 'ComidaFavorita', 'Localidade', 'Nascimento']
-        for c in cols_str:
-            if c not in df.columns: df[c] = ""
-            df[c] = df[c].astype(str).replace('nan', '')
-        
-        if 'Pontos' not in df.columns: df['Pontos'] = 0
-        df['Pontos'] = pd.to_numeric(df['Pontos'], errors='coerce').fillna(0).astype(int)
-        
-        if 'Idade' not in df.columns: df['Idade'] = 0
-        df['Idade'] = pd.to_numeric(df['Idade'], errors='coerce').fillna(0).astype(int)
-        
-        # Executa a verificação de idades
-        df, mudou = verificar_atualizacoes_automaticas(df)
-        if mudou:
-            conn.update(worksheet="Sheet1", data=df)
+        ligacao.client._client.session.hooks['response'].append(obter_diagnostico().http)
+    except Exception:
+        pass
+
+@st.cache_resource
+def obter_armazenamento():
+    # Motor escolhido em st.secrets: armazenamento = "gsheets" (por omissão) ou "sqlite"
+    if ler_config("armazenamento", "gsheets") == "sqlite":
+        return ArmazenamentoMedido(ArmazenamentoSQLite(config_loja(LOJA, "sqlite_caminho", ler_config("sqlite_caminho", "kaokente.db"))))
+    _contar_http(conn)
+    return ArmazenamentoMedido(ArmazenamentoSheets(conn, LOJAS.get(LOJA), obter_leituras()))
+
+def armazenamento_loja(loja):
+    # Motor de outra loja, só para consultas pontuais (não partilha snapshot, livro nem fila).
+    # Em SQLite só lojas com sqlite_caminho configurado e base já existente (None para as outras).
+    if loja == LOJA: return obter_armazenamento()
+    if obter_armazenamento().nome == "sqlite":
+        caminho = config_loja(loja, "sqlite_caminho", None)
+        return ArmazenamentoMedido(ArmazenamentoSQLite(caminho, criar=False)) if caminho else None
+    return ArmazenamentoMedido(ArmazenamentoSheets(conn, LOJAS.get(loja), obter_leituras()))
+
+def procurar_noutras_lojas(telemovel):
+    # Consulta explícita: em cada outra loja só a coluna dos telemóveis e a linha do cliente
+    encontrados = []
+    for loja in LOJAS:
+        if loja == LOJA: continue
+        try:
+            motor = armazenamento_loja(loja)
+            if motor is None: continue
+            linha = motor.obter_cliente(telemovel)
+        except Exception:
+            continue
+        if linha is not None: encontrados.append({"Loja": loja, **normalizar_clientes(pd.DataFrame([linha])).iloc[0][['Nome', 'Apelido', 'Tipo', 'Pontos']].to_dict()})
+    return pd.DataFrame(encontrados)
+
+# --- CÓPIA LOCAL DOS CLIENTES (ARRANQUE RÁPIDO E FALHAS DO SHEETS) ---
+# Depois de cada leitura boa o snapshot vai para um ficheiro Arrow IPC, lido com memory map. Serve no
+# arranque, enquanto a folha é lida em segundo plano, e quando o Sheets falha: só leitura, com os
+# lançamentos na fila e os pontos acertados pela diferença quando a folha voltar.
+SNAPSHOT_LOCAL = ler_config("snapshot_local", f"snapshot_{LOJA}.arrow")
+_gravacao_local = threading.Lock()
+
+def copia_local_ativa():
+    # Só com o Sheets: o SQLite já é local
+    return bool(SNAPSHOT_LOCAL) and obter_armazenamento().nome == "gsheets"
+
+def gravar_snapshot_local(df):
+    # Uma gravação de cada vez; a cópia é só uma ajuda, por isso os erros ficam por aqui
+    if not _gravacao_local.acquire(blocking=False): return
+    try:
+        import pyarrow as pa
+        tabela = pa.Table.from_pandas(df, preserve_index=True)
+        with pa.OSFile(SNAPSHOT_LOCAL + ".tmp", "wb") as f, pa.ipc.new_file(f, tabela.schema) as escritor:
+            escritor.write_table(tabela)
+        os.replace(SNAPSHOT_LOCAL + ".tmp", SNAPSHOT_LOCAL)
+    except Exception:
+        pass
+    finally:
+        _gravacao_local.release()
+
+def ler_snapshot_local():
+    try:
+        import pyarrow as pa
+        df = pa.ipc.open_file(pa.memory_map(SNAPSHOT_LOCAL)).read_all().to_pandas()
+    except Exception:
+        return None
+    return df if 'Telemovel' in df.columns else None
+
+def _servir_local(snap):
+    # Chamado com o lock do snapshot. A cópia em memória, mesmo antiga, é mais recente do que a do disco
+    if snap.df is not None:
+        snap.local = True
+        snap.carregado_em = time.monotonic()
+        return True
+    if not copia_local_ativa(): return False
+    df = ler_snapshot_local()
+    if df is None: return False
+    if fila_ativa(): df = obter_fila().sobrepor_clientes(df, remoto=False)
+    snap.guardar(df, local=True)
+    snap.lido_em = datetime.fromtimestamp(os.path.getmtime(SNAPSHOT_LOCAL))
+    return True
+
+def _ler_folha_em_fundo():
+    snap = obter_snapshot()
+    with snap.lock: snap.carregado_em = 0.0
+    load_data()
+
+@medido("load_data")
+def load_data():
+    # A leitura da folha (e as novas tentativas na quota) corre fora do lock do snapshot: enquanto dura,
+    # quem tem uma cópia recebe-a e quem não tem junta-se à mesma leitura (LeiturasPartilhadas)
+    snap = obter_snapshot()
+    for tentativa in range(2):
+        with snap.lock:
+            if snap.fresco():
+                snap.hits += 1
+                return snap.copia()
+            snap.misses += 1
+            # Arranque: a cópia local responde já e a folha é lida em segundo plano
+            if snap.df is None and not snap.arrancou:
+                snap.arrancou = True
+                if _servir_local(snap):
+                    threading.Thread(target=_ler_folha_em_fundo, daemon=True).start()
+                    return snap.copia()
+            if snap.lendo and snap.df is not None: return snap.copia()
+            snap.lendo = True
+            versao = snap.versao
+        try:
+            df = obter_armazenamento().ler_clientes()
+        except Exception:
+            # Sheets indisponível: fica a servir a última cópia (em memória ou no disco)
+            with snap.lock:
+                snap.lendo = False
+                if _servir_local(snap): return snap.copia()
+                return pd.DataFrame()
+        with snap.lock:
+            snap.lendo = False
+            if df is None or df.empty: 
+                return pd.DataFrame(columns=COLUNAS_CLIENTES)
+            # Escrita ou invalidação durante a leitura: a folha lida pode ser anterior a ela.
+            # Fica a cópia em memória, que já a tem; sem cópia, lê outra vez (à segunda guarda)
+            if snap.versao != versao and tentativa == 0:
+                if snap.df is not None: return snap.copia()
+                continue
+            
+            df = normalizar_clientes(df)
+            # Alterações ainda na fila de escrita por cima do que veio da folha
+            if fila_ativa(): df = obter_fila().sobrepor_clientes(df)
+            snap.guardar(df[df['Telemovel'].str.len() > 3])
+            snap.lido_em = datetime.now()
+            if copia_local_ativa(): threading.Thread(target=gravar_snapshot_local, args=(snap.copia(),), daemon=True).start()
             
-        return df[df['Telemovel'].str.len() > 3]
-    except: return pd.DataFrame()
+            # A verificação de idades corre no máximo uma vez por dia, fora do pedido
+            if snap.manutencao_em != date.today():
+                snap.manutencao_em = date.today()
+                threading.Thread(target=_manutencao_medida, daemon=True).start()
+            return snap.copia()
 
+@medido("load_contas")
+def load_contas():
+    # Só as colunas quentes (login e saldo): do snapshot completo se estiver fresco, senão uma leitura projetada
+    snap = obter_snapshot()
+    with snap.lock:
+        if snap.fresco():
+            snap.hits += 1
+            return snap.copia_contas()
+        if snap.contas_frescas():
+            snap.hits += 1
+            return snap.contas[2].copy()
+        snap.misses += 1
+        if snap.lendo and snap.df is not None: return snap.copia_contas()
+        versao = snap.versao
+    # Como no load_data: a leitura fora do lock, partilhada por quem pedir o mesmo ao mesmo tempo
+    try:
+        df = obter_armazenamento().ler_colunas(COLUNAS_CONTA)
+    except Exception:
+        with snap.lock:
+            if _servir_local(snap): return snap.copia_contas()
+            return pd.DataFrame()
+    if df is None or df.empty:
+        return pd.DataFrame(columns=COLUNAS_CONTA)
+    
+    df = normalizar_clientes(df, COLUNAS_CONTA)[COLUNAS_CONTA]
+    if fila_ativa(): df = obter_fila().sobrepor_clientes(df)
+    df = df[df['Telemovel'].str.len() > 3]
+    with snap.lock:
+        # Escrita ou invalidação durante a leitura: serve esta leitura, mas não a guarda
+        if snap.versao != versao: return df
+        snap.guardar_contas(df)
+        return snap.contas[2].copy()
+
+@medido("save_data")
 def save_data(df):
+    # Reescrita completa (fallback das escritas incrementais). Devolve False se a alteração não foi guardada
+    snap = obter_snapshot()
+    with snap.lock:
+        if snap.local:
+            # Reescrever a folha a partir da cópia local apagaria o que mudou entretanto
+            st.error("Sem ligação ao Sheets: alteração não guardada")
+            return False
+        try:
+            guardado = obter_armazenamento().reescrever_clientes(df)
+            st.cache_data.clear()
+            # Atualiza logo o snapshot para que ninguém veja dados anteriores à sua escrita
+            snap.guardar(guardado)
+            return True
+        except Exception as e:
+            snap.invalidar()
+            st.error(f"Erro: {e}")
+            return False
+
+def obter_cliente(telemovel):
+    # Leitura de um só cliente, sem passar pelo snapshot completo
+    try:
+        linha = obter_armazenamento().obter_cliente(telemovel)
+    except Exception:
+        # Sheets indisponível: procura no snapshot (em memória ou na cópia local)
+        snap = obter_snapshot()
+        with snap.lock:
+            if not _servir_local(snap): raise
+            idx = snap.indice_atual().linha_telemovel(telemovel)
+            return None if idx is None else snap.df.loc[idx].copy()
+    if linha is None: return None
+    df = normalizar_clientes(pd.DataFrame([linha]))
+    if fila_ativa(): df = obter_fila().sobrepor_clientes(df)
+    return df.iloc[0]
+
+# --- ESCRITA INCREMENTAL (SÓ AS CÉLULAS ALTERADAS) ---
+def _escrever_celulas(snap, alteracoes):
+    # alteracoes = {idx: {coluna: valor}}, enviadas numa só operação
+    if snap.df is None or any(i not in snap.df.index for i in alteracoes):
+        raise LookupError("Snapshot desatualizado")
+    obter_armazenamento().atualizar_campos(alteracoes, {i: snap.df.at[i, 'Telemovel'] for i in alteracoes})
+    for i, campos in alteracoes.items():
+        for c, v in campos.items(): snap.df.at[i, c] = v
+    snap.alterado()
+
+def inserir_cliente(registo):
+    # Devolve False se o cliente não ficou guardado (o erro já foi mostrado)
+    snap = obter_snapshot()
+    with snap.lock:
+        try:
+            obter_armazenamento().inserir_cliente(registo)
+            # A posição da nova linha só é conhecida na próxima leitura
+            snap.invalidar()
+            return True
+        except Exception as e:
+            # Sem reescrever a folha a partir da cópia da página (apagaria o que mudou entretanto)
+            st.error(f"Erro: {e}. Conta não criada")
+            return False
+
+def _escrever_cliente(telemovel, escrever):
+    # A linha vem do snapshot do processo, procurada pelo telemóvel (nunca o idx da cópia da sessão).
+    # Se entretanto mudou de sítio (registo ou apagado noutro terminal), relê a folha e tenta mais uma vez.
+    snap = obter_snapshot()
+    for tentativa in range(2):
+        if tentativa: snap.invalidar()
+        load_data()
+        with snap.lock:
+            if snap.df is None or snap.local: raise RuntimeError("Sem ligação ao armazenamento")
+            i = snap.indice_atual().linha_telemovel(telemovel)
+            if i is None: raise LookupError("Cliente não encontrado")
+            try:
+                return escrever(snap, i)
+            except LookupError:
+                if tentativa: raise
+
+def atualizar_cliente(df, idx, campos):
+    # Devolve False se a alteração não ficou guardada (o erro já foi mostrado)
+    if not campos: return True
+    snap = obter_snapshot()
+    fila = obter_fila() if fila_ativa() else None
+    tel_antigo = df.at[idx, 'Telemovel']
+    if fila and 'Telemovel' not in campos:
+        with snap.lock:
+            i = snap.indice_atual().linha_telemovel(tel_antigo) if snap.df is not None else None
+            if i is not None:
+                for c, v in campos.items(): snap.df.at[i, c] = v
+                snap.alterado()
+        fila.campos(tel_antigo, campos)
+        for c, v in campos.items(): df.at[idx, c] = v
+        return True
+    
+    # Mudança de telemóvel (a chave da fila): envia o pendente e escreve já
+    with (fila.envio if fila else nullcontext()):
+        if fila: fila.esvaziar()
+        try:
+            _escrever_cliente(tel_antigo, lambda snap, i: _escrever_celulas(snap, {i: campos}))
+        except Exception as e:
+            st.error(f"Erro: {e}")
+            return False
+        if fila and 'Telemovel' in campos: fila.renomear(tel_antigo, campos['Telemovel'])
+    for c, v in campos.items(): df.at[idx, c] = v
+    return True
+
+def _apagar_linha(snap, i):
+    obter_armazenamento().apagar_cliente(i, snap.df.at[i, 'Telemovel'])
+    # As linhas seguintes podem mudar de posição: força nova leitura
+    snap.invalidar()
+
+def apagar_cliente(df, idx):
+    # Devolve False se o cliente não foi apagado (o erro já foi mostrado)
     try:
-        conn.update(worksheet="Sheet1", data=df)
-        st.cache_data.clear()
-    except Exception as e: st.error(f"Erro: {e}")
+        _escrever_cliente(df.at[idx, 'Telemovel'], _apagar_linha)
+        return True
+    except Exception as e:
+        st.error(f"Erro: {e}")
+        return False
+
+# --- PONTOS (LANÇAR / RESGATAR SEM PERDER ATUALIZAÇÕES) ---
+class TrincosClientes:
+    # Um trinco por cliente, partilhado por todas as sessões (vários terminais no mesmo processo)
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._trincos = {}
+
+    def __call__(self, telemovel):
+        with self._lock:
+            return self._trincos.setdefault(normalizar_telemovel(telemovel), threading.Lock())
+
+@st.cache_resource
+def obter_trincos():
+    return TrincosClientes()
+
+def movimentar_pontos(df, idx, delta, movimento):
+    # Soma delta ao saldo atual no armazenamento (nunca ao valor da sessão) e regista o movimento
+    telemovel = df.at[idx, 'Telemovel']
+    if fila_ativa(): return _movimentar_pontos_diferido(df, idx, delta, movimento)
+    with obter_trincos()(telemovel):
+        novo = somar_pontos(obter_armazenamento(), idx, telemovel, delta)
+    
+    df.at[idx, 'Pontos'] = novo
+    _pontos_no_snapshot(idx, telemovel, novo)
+    registar_movimentos([movimento])
+    return novo
+
+def _pontos_no_snapshot(idx, telemovel, novo):
+    # Saldo já guardado: o snapshot acompanha-o, se a linha ainda for a deste cliente
+    snap = obter_snapshot()
+    with snap.lock:
+        if snap.df is not None and idx in snap.df.index and normalizar_telemovel(snap.df.at[idx, 'Telemovel']) == normalizar_telemovel(telemovel):
+            snap.df.at[idx, 'Pontos'] = novo
+            snap.alterado()
+
+def _movimentar_pontos_diferido(df, idx, delta, movimento):
+    # Com a fila ativa o snapshot (já com o pendente aplicado) é o saldo de referência do processo
+    telemovel = df.at[idx, 'Telemovel']
+    snap = obter_snapshot()
+    with snap.lock:
+        if not snap.fresco(): load_data()
+        i = snap.indice_atual().linha_telemovel(telemovel) if snap.df is not None else None
+        if i is None: raise LookupError("Cliente não encontrado")
+        atual = int(snap.df.at[i, 'Pontos'])
+        novo = atual + delta
+        if novo < 0: raise SaldoInsuficiente(f"Saldo insuficiente ({atual} pontos)")
+        snap.df.at[i, 'Pontos'] = novo
+        snap.alterado()
+        obter_fila().campos(telemovel, {'Pontos': novo}, base_pontos=atual if snap.local else None)
+    
+    df.at[idx, 'Pontos'] = novo
+    registar_movimentos([movimento])
+    return novo
+
+# --- FILA DE ESCRITA DIFERIDA (SHEETS) ---
+# Lançamentos e edições respondem logo: as alterações ficam em memória, juntas por cliente,
+# e uma thread envia-as em lote. Cada alteração vai logo também para um ficheiro local (a espera da
+# quota pode durar minutos), para um reinício não perder o que ainda não chegou à folha.
+ESCRITA_DIFERIDA = bool(ler_config("escrita_diferida", True))
+FILA_INTERVALO_SEGUNDOS = float(ler_config("fila_intervalo_segundos", 5))
+FILA_MAXIMO = int(ler_config("fila_maximo", 50))
+# Um ficheiro por loja, como a cópia local: duas lojas na mesma pasta nunca repetem as escritas uma da outra
+FILA_SPOOL = ler_config("fila_spool", f"fila_escritas_{LOJA}.json")
+
+class FilaEscritas:
+    def __init__(self, spool):
+        self.lock = threading.Lock()
+        self.envio = threading.RLock()
+        self.acordar = threading.Event()
+        self.spool = spool
+        self.clientes = {}
+        self.movimentos = []
+        # Saldo de partida dos pontos lançados sobre a cópia local, por telemóvel
+        self.bases = {}
+        self.em_envio = ({}, [])
+        self.enviados = 0
+        self.falhas = 0
+        self.quota = False
+        self.ultimo_erro = None
+        self.espera = FILA_INTERVALO_SEGUNDOS
+        self._ler_spool()
+
+    def pendentes(self):
+        with self.lock:
+            return len(self.clientes) + len(self.movimentos)
+
+    def pendentes_movimentos(self):
+        with self.lock:
+            return len(self.movimentos)
+
+    def campos(self, telemovel, campos, base_pontos=None):
+        # Valores absolutos: o último ganha, e reenviar não muda nada
+        tel = normalizar_telemovel(telemovel)
+        with self.lock:
+            self.clientes.setdefault(tel, {}).update({c: valor_celula(v) for c, v in campos.items()})
+            if base_pontos is not None: self.bases.setdefault(tel, int(base_pontos))
+            self._gravar_spool()
+        self._limite()
+
+    def acrescentar_movimentos(self, novos):
+        with self.lock:
+            self.movimentos.extend(novos[COLUNAS_MOVIMENTOS].to_dict('records'))
+            self._gravar_spool()
+        self._limite()
+
+    def _limite(self):
+        # Durante o backoff não adianta acordar mais cedo
+        if self.pendentes() >= FILA_MAXIMO and not self.falhas: self.acordar.set()
+
+    def renomear(self, antigo, novo):
+        antigo, novo = normalizar_telemovel(antigo), normalizar_telemovel(novo)
+        with self.lock:
+            if antigo in self.clientes:
+                self.clientes[novo] = {**self.clientes.pop(antigo), **self.clientes.get(novo, {})}
+            if antigo in self.bases: self.bases[novo] = self.bases.pop(antigo)
+            for m in self.movimentos:
+                if m['Cliente'] == antigo: m['Cliente'] = novo
+            self._gravar_spool()
+
+    def sobrepor_clientes(self, df, remoto=True):
+        # Uma leitura da folha ainda não tem o que está na fila (nem o que está a ser enviado)
+        with self.lock:
+            if not self.clientes and not self.em_envio[0]: return df
+            linhas = dict(zip(df['Telemovel'].map(normalizar_telemovel)[::-1], df.index[::-1]))
+            if remoto and self.bases and 'Pontos' in df.columns: self._acertar_pontos(df, linhas)
+            pendentes = {**self.em_envio[0]}
+            for tel, campos in self.clientes.items(): pendentes[tel] = {**pendentes.get(tel, {}), **campos}
+        for tel, campos in pendentes.items():
+            if tel in linhas:
+                # Uma leitura projetada só recebe as colunas que tem
+                for c, v in campos.items():
+                    if c in df.columns: df.at[linhas[tel], c] = v
+        return df
+
+    def _acertar_pontos(self, df, linhas):
+        # Pontos lançados sobre a cópia local: conta a diferença, somada ao saldo que a folha tem agora
+        for tel in [t for t in self.bases if t in linhas]:
+            desvio = int(df.at[linhas[tel], 'Pontos']) - self.bases.pop(tel)
+            for pendentes in (self.em_envio[0], self.clientes):
+                if 'Pontos' in pendentes.get(tel, {}): pendentes[tel]['Pontos'] += desvio
+        self._gravar_spool()
+
+    def movimentos_pendentes(self):
+        with self.lock:
+            return pd.DataFrame(self.em_envio[1] + self.movimentos, columns=COLUNAS_MOVIMENTOS)
+
+    def esvaziar(self):
+        # Envia tudo o que está pendente: no máximo uma escrita de clientes e uma do livro
+        with self.envio:
+            with self.lock:
+                clientes, movimentos = self.clientes, self.movimentos
+                self.clientes, self.movimentos = {}, []
+                self.em_envio = (clientes, movimentos)
+            if not clientes and not movimentos: return True
+            try:
+                if clientes: _enviar_clientes(clientes)
+                if movimentos: _enviar_movimentos(movimentos)
+            except Exception as e:
+                with self.lock:
+                    for tel, campos in clientes.items():
+                        self.clientes[tel] = {**campos, **self.clientes.get(tel, {})}
+                    self.movimentos = movimentos + self.movimentos
+                    self.em_envio = ({}, [])
+                    self.falhas += 1
+                    self.quota = erro_quota(e)
+                    self.ultimo_erro = str(e)
+                    self._gravar_spool()
+                return False
+            with self.lock:
+                self.em_envio = ({}, [])
+                for tel in clientes: self.bases.pop(tel, None)
+                self.enviados += 1
+                self.falhas = 0
+                self.quota = False
+                self._gravar_spool()
+            return True
+
+    def correr(self):
+        while True:
+            self.acordar.wait(self.espera)
+            self.acordar.clear()
+            if not self.pendentes():
+                self.espera = FILA_INTERVALO_SEGUNDOS
+                continue
+            with obter_diagnostico().execucao("fila_escrita"):
+                enviado = self.esvaziar()
+            if enviado:
+                self.espera = FILA_INTERVALO_SEGUNDOS
+            elif self.quota:
+                # Quota do Sheets é por minuto: espera pelo menos isso
+                self.espera = min(max(60.0, self.espera * 2), 300.0)
+            else:
+                self.espera = min(self.espera * 2, 60.0)
+
+    def _gravar_spool(self):
+        # Chamado com o lock. O que está a ser enviado também fica, até o envio correr bem
+        clientes = {**self.em_envio[0]}
+        for tel, campos in self.clientes.items(): clientes[tel] = {**clientes.get(tel, {}), **campos}
+        movimentos = self.em_envio[1] + self.movimentos
+        if not clientes and not movimentos:
+            if os.path.exists(self.spool): os.remove(self.spool)
+            return
+        movimentos = [{**m, 'Data': m['Data'].strftime(FORMATO_DATA_MOVIMENTO)} for m in movimentos]
+        try:
+            with open(self.spool + ".tmp", "w", encoding="utf-8") as f:
+                json.dump({"clientes": clientes, "movimentos": movimentos, "bases": self.bases}, f, ensure_ascii=False)
+            os.replace(self.spool + ".tmp", self.spool)
+        except OSError:
+            pass
+
+    def _ler_spool(self):
+        # Pendentes de uma execução anterior que não chegaram à folha
+        try:
+            with open(self.spool, encoding="utf-8") as f:
+                dados = json.load(f)
+        except (OSError, ValueError):
+            return
+        self.clientes = dados.get("clientes", {})
+        self.bases = dados.get("bases", {})
+        self.movimentos = [{**m, 'Data': datetime.strptime(m['Data'], FORMATO_DATA_MOVIMENTO)} for m in dados.get("movimentos", [])]
+
+@st.cache_resource
+def obter_fila():
+    # O ficheiro partilhado das versões anteriores só é retomado sem outras lojas configuradas
+    antigo = "fila_escritas.json"
+    if ler_config("fila_spool") is None and set(LOJAS) <= {LOJA} and os.path.exists(antigo) and not os.path.exists(FILA_SPOOL):
+        os.replace(antigo, FILA_SPOOL)
+    fila = FilaEscritas(FILA_SPOOL)
+    threading.Thread(target=fila.correr, daemon=True).start()
+    return fila
+
+def fila_ativa():
+    # Só para o Sheets: no SQLite local cada escrita já é barata.
+    # Com ou sem ela, a fila guarda os movimentos que a escrita direta recusou (ver registar_movimentos).
+    return ESCRITA_DIFERIDA and obter_armazenamento().nome == "gsheets"
+
+def _enviar_clientes(clientes):
+    snap = obter_snapshot()
+    with snap.lock:
+        # Sobre a cópia local não se escreve: força uma leitura da folha, que também acerta os pontos
+        if snap.local: snap.carregado_em = 0.0
+        if not snap.fresco(): load_data()
+        if snap.df is None or snap.local: raise RuntimeError("Clientes indisponíveis")
+        indice = snap.indice_atual()
+        # Clientes que entretanto foram apagados ficam de fora
+        alteracoes = {indice.linha_telemovel(t): campos for t, campos in clientes.items() if indice.linha_telemovel(t) is not None}
+        if not alteracoes: return
+        try:
+            _escrever_celulas(snap, alteracoes)
+        except LookupError:
+            # Linhas mudaram de sítio noutro terminal: relê na próxima tentativa
+            snap.invalidar()
+            raise
+        except Exception as e:
+            if erro_quota(e): raise
+            # Sem escrita por células (ligação pública): reescreve a folha, que já tem o pendente
+            snap.guardar(obter_armazenamento().reescrever_clientes(snap.df))
+
+def _enviar_movimentos(movimentos):
+    # Qualquer erro (quota, 5xx, rede) deixa os movimentos na fila para a próxima tentativa.
+    # Reescrever o livro inteiro por causa de uma falha passageira só abria outra janela para o perder.
+    obter_armazenamento().acrescentar_movimentos(pd.DataFrame(movimentos, columns=COLUNAS_MOVIMENTOS))
+
+# --- LIVRO DE MOVIMENTOS (HISTÓRICO ESTRUTURADO) ---
+# Substitui o texto livre da coluna Historico: uma linha tipada por movimento, só acrescentada
+class LivroMovimentos:
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.df = None
+        self.carregado_em = 0.0
+        self.versao = 0
+        self._indices = None
+        self.resumo = None
+
+    def fresco(self):
+        return self.df is not None and (time.monotonic() - self.carregado_em) < CACHE_TTL_SEGUNDOS
+
+    def guardar(self, df):
+        self.df = df.reset_index(drop=True)
+        self.versao += 1
+        self.carregado_em = time.monotonic()
+
+    def acrescentar(self, novos):
+        self.df = pd.concat([self.df, novos], ignore_index=True) if len(self.df) else novos.reset_index(drop=True)
+        self.versao += 1
+
+    def indices(self):
+        # Posições por cliente, reconstruídas só quando o livro muda.
+        # Sem índice por (cliente, mês): agrupar pela coluna Period é muito lento e cada cliente tem poucas linhas.
+        if self._indices is None or self._indices[0] != self.versao:
+            self._indices = (self.versao, self.df.groupby('Cliente', sort=False).indices)
+        return self._indices[1]
+
+    def movimentos(self, cliente, mes=None):
+        mov = self.df.iloc[self.indices().get(normalizar_telemovel(cliente), [])]
+        return mov if mes is None else mov[mov['Mes'] == pd.Period(mes, 'M')]
+
+@st.cache_resource
+def obter_livro():
+    return LivroMovimentos()
+
+def carregar_movimentos():
+    # Ordem dos locks: nunca pedir o do snapshot de clientes com o do livro na mão
+    livro = obter_livro()
+    with livro.lock:
+        if livro.fresco(): return livro
+        raw = obter_armazenamento().ler_movimentos()
+        if raw is not None:
+            livro.guardar(normalizar_movimentos(raw))
+            _sobrepor_movimentos(livro)
+            return livro
+    
+    # Migração única: o livro ainda não existe, por isso passa o Historico de texto para lá
+    clientes = load_data()
+    if 'Telemovel' not in clientes.columns: raise RuntimeError("Clientes indisponíveis")
+    with livro.lock:
+        if livro.fresco(): return livro
+        mov = converter_historico(clientes)
+        obter_armazenamento().reescrever_movimentos(mov)
+        livro.guardar(mov)
+        _sobrepor_movimentos(livro)
+        return livro
+
+def _sobrepor_movimentos(livro):
+    # Movimentos ainda na fila de escrita ficam no fim do livro, depois dos guardados
+    pendentes = obter_fila().movimentos_pendentes()
+    if len(pendentes): livro.acrescentar(normalizar_movimentos(pendentes))
+
+def _movimentos_guardados(livro):
+    # O livro sem a cauda que ainda está na fila (essa segue pela fila)
+    return livro.df.iloc[:len(livro.df) - obter_fila().pendentes_movimentos()]
+
+def registar_movimentos(movimentos):
+    # Chamado com o saldo já guardado: não lê o livro e não devolve erros (um "Erro" levava a lançar outra vez).
+    # O movimento vai primeiro para o armazenamento ou para a fila; o livro em memória só o recebe se já estiver carregado.
+    if not movimentos: return
+    novos = pd.DataFrame(movimentos, columns=COLUNAS_MOVIMENTOS)
+    novos['Mes'] = novos['Data'].dt.to_period('M')
+    livro = obter_livro()
+    fila = obter_fila()
+    with (nullcontext() if fila_ativa() else fila.envio), livro.lock:
+        # Com movimentos já na fila, os novos vão atrás deles para o livro manter a ordem
+        direto = not fila_ativa() and not fila.pendentes_movimentos()
+        if direto:
+            try:
+                obter_armazenamento().acrescentar_movimentos(novos)
+            except Exception:
+                direto = False
+        if not direto: fila.acrescentar_movimentos(novos)
+        if livro.df is not None: livro.acrescentar(novos)
+
+def _reescrever_movimentos(livro):
+    # Fallback: reescreve o livro inteiro, como o save_data faz com os clientes
+    try:
+        obter_armazenamento().reescrever_movimentos(_movimentos_guardados(livro))
+    except Exception as e:
+        livro.df = None
+        st.error(f"Erro: {e}")
+
+def renomear_cliente_movimentos(antigo, novo):
+    # Mantém a chave do livro quando o telemóvel de um cliente é editado
+    livro = carregar_movimentos()
+    fila = obter_fila()
+    with fila.envio, livro.lock:
+        pos = livro.indices().get(normalizar_telemovel(antigo), [])
+        if not len(pos): return
+        livro.df.loc[pos, 'Cliente'] = normalizar_telemovel(novo)
+        livro.versao += 1
+        fila.renomear(antigo, novo)
+        # Na folha só as linhas já guardadas; as pendentes foram renomeadas na fila
+        pos = [p for p in pos if p < len(_movimentos_guardados(livro))]
+        try:
+            if pos: obter_armazenamento().renomear_movimentos(antigo, novo, pos)
+        except Exception:
+            _reescrever_movimentos(livro)
+
+# --- COMPACTAÇÃO DO HISTÓRICO (ARQUIVO + RESUMOS MENSAIS) ---
+# Os meses recentes ficam no livro tal como estão. Os mais antigos passam, linha a linha, para o
+# arquivo e no livro fica uma linha "Resumo" por cliente e mês. O Historico de texto já migrado é limpo.
+HISTORICO_MESES_RECENTES = max(2, int(ler_config("historico_meses_recentes", 3)))
+log_manutencao = logging.getLogger("kaokente.manutencao")
+
+def compactar_historico(hoje=None):
+    livro = carregar_movimentos()
+    inicio = (pd.Period(hoje or datetime.now(), 'M') - (HISTORICO_MESES_RECENTES - 1)).start_time
+    arquivados = resumos = 0
+    with obter_fila().envio, livro.lock:
+        # Só as linhas já guardadas; a cauda na fila segue pela fila
+        guardados = _movimentos_guardados(livro)
+        antigos = (guardados['Data'] < inicio) & (guardados['Tipo'] != 'Resumo')
+        if antigos.any():
+            resumo = resumir_movimentos(guardados[antigos])
+            compactado = pd.concat([resumo, guardados[~antigos]], ignore_index=True).sort_values('Data', kind='stable', na_position='first')
+            # Primeiro o arquivo. A reescrita nunca deixa o livro vazio: se falhar, o livro fica como estava
+            # e a próxima compactação só repete essas linhas no arquivo
+            obter_armazenamento().acrescentar_arquivo(guardados[antigos])
+            obter_armazenamento().reescrever_movimentos(compactado)
+            livro.guardar(pd.concat([compactado, livro.df.iloc[len(guardados):]], ignore_index=True))
+            arquivados, resumos = int(antigos.sum()), len(resumo)
+    
+    # O Historico de texto já está no livro desde a migração: as células voltam a ficar vazias
+    snap = obter_snapshot()
+    with snap.lock:
+        load_data()
+        if snap.df is None or snap.local: raise RuntimeError("Clientes indisponíveis")
+        alteracoes = {i: {'Historico': ""} for i in snap.df.index[snap.df['Historico'] != ""]}
+        if alteracoes:
+            try:
+                _escrever_celulas(snap, alteracoes)
+            except Exception as e:
+                # Nunca reescreve a folha a partir do snapshot (pode estar atrás dela): fica para a próxima manutenção
+                if isinstance(e, LookupError): snap.invalidar()
+                log_manutencao.warning("Historico por limpar em %d clientes: %s", len(alteracoes), e)
+                alteracoes = {}
+    return {"arquivados": arquivados, "resumos": resumos, "historicos": len(alteracoes)}
+
+def ler_arquivo_cliente(telemovel):
+    raw = obter_armazenamento().ler_arquivo(telemovel)
+    return None if raw is None else normalizar_movimentos(raw.copy())
+
+# --- SINCRONIZAÇÃO ENTRE O MOTOR LOCAL E O SHEETS ---
+def sincronizar_para_sheets():
+    local = obter_armazenamento()
+    remoto = ArmazenamentoMedido(ArmazenamentoSheets(conn, LOJAS.get(LOJA), obter_leituras()))
+    clientes = normalizar_clientes(local.ler_clientes())
+    # O apóstrofo mantém o telemóvel como texto na folha
+    remoto.reescrever_clientes(clientes.assign(Telemovel="'" + clientes['Telemovel'].map(normalizar_telemovel))[COLUNAS_CLIENTES])
+    mov = local.ler_movimentos()
+    if mov is not None: remoto.reescrever_movimentos(normalizar_movimentos(mov))
+    return len(clientes)
+
+def importar_de_sheets():
+    local = obter_armazenamento()
+    remoto = ArmazenamentoMedido(ArmazenamentoSheets(conn, LOJAS.get(LOJA), obter_leituras()))
+    clientes = normalizar_clientes(remoto.ler_clientes())
+    local.reescrever_clientes(clientes[clientes['Telemovel'].str.len() > 3])
+    mov = remoto.ler_movimentos()
+    if mov is not None: local.reescrever_movimentos(normalizar_movimentos(mov))
+    obter_snapshot().invalidar()
+    obter_livro().df = None
+    return len(clientes)
+
+# --- RESUMO MENSAL (TODOS OS CLIENTES) ---
+def obter_resumo(df):
+    # Guardado por versão do livro e do snapshot de clientes
+    livro = carregar_movimentos()
+    with livro.lock:
+        chave = (livro.versao, df.attrs.get('versao'), pd.Period(datetime.now(), 'M'))
+        if livro.resumo is None or livro.resumo[0] != chave or chave[1] is None:
+            livro.resumo = (chave, calcular_resumo(livro.df, df))
+        return livro.resumo[1]
+
+# --- IMPORTAÇÃO DE VENDAS (EXPORTAÇÃO DA CAIXA) ---
+def aplicar_importacao(aceites):
+    # Com a fila, os saldos novos de todos os clientes vão num só lote (o snapshot é a referência do processo).
+    # Sem ela, cada saldo é somado no armazenamento como num Lançar: trinco do cliente e compare-and-swap.
+    por_cliente = aceites.groupby('Telemovel')['Pontos'].sum()
+    snap = obter_snapshot()
+    fila = obter_fila() if fila_ativa() else None
+    with snap.lock:
+        # Sem fila, as linhas dos clientes vêm de uma leitura acabada de fazer
+        if not fila: snap.invalidar()
+        load_data()
+        if snap.df is None: raise RuntimeError("Clientes indisponíveis")
+        indice = snap.indice_atual()
+        linhas = {tel: indice.linha_telemovel(tel) for tel in por_cliente.index if indice.linha_telemovel(tel) is not None}
+        if fila:
+            for tel, i in linhas.items():
+                atual = int(snap.df.at[i, 'Pontos'])
+                snap.df.at[i, 'Pontos'] = atual + int(por_cliente[tel])
+                fila.campos(snap.df.at[i, 'Telemovel'], {'Pontos': atual + int(por_cliente[tel])}, base_pontos=atual if snap.local else None)
+            snap.alterado()
+        telemoveis = {tel: snap.df.at[i, 'Telemovel'] for tel, i in linhas.items()}
+    
+    falhas = []
+    if not fila:
+        # Fora do lock do snapshot: o trinco do cliente vem sempre antes dele
+        for tel, i in list(linhas.items()):
+            try:
+                with obter_trincos()(telemoveis[tel]):
+                    novo = somar_pontos(obter_armazenamento(), i, telemoveis[tel], int(por_cliente[tel]))
+                _pontos_no_snapshot(i, telemoveis[tel], novo)
+            except Exception as e:
+                del linhas[tel]
+                falhas.append(f"{tel}: {e}")
+    
+    # Só os movimentos de quem recebeu os pontos: importar o ficheiro outra vez trata do resto
+    registar_movimentos(movimentos_importacao(aceites[aceites['Telemovel'].isin(linhas)]).to_dict('records'))
+    return len(linhas), int(por_cliente[list(linhas)].sum()), falhas
+
+# --- TABELA DE CLIENTES (PAGINADA NO SERVIDOR) ---
+# Filtra e ordena no servidor; para o browser só vai a página atual com as colunas escolhidas
+TABELA_POR_PAGINA = 50
+TABELA_COLUNAS_OMISSAO = COLUNAS_EXPORTACAO
+TABELA_ORDENACAO = ["Nome", "Apelido", "Pontos", "Idade", "Tipo", "Localidade", "Telemovel"]
+
+# --- MANUTENÇÃO DIÁRIA (IDADES E ESTUDANTES) ---
+def manutencao_diaria():
+    snap = obter_snapshot()
+    with snap.lock:
+        if snap.df is None: return
+        try:
+            alteracoes, migrados_tel = alteracoes_manutencao(snap.df)
+            # Só as linhas alteradas voltam à folha
+            if alteracoes: _escrever_celulas(snap, alteracoes)
+            idades = sum('Idade' in campos for campos in alteracoes.values())
+            snap.relatorio_manutencao = {"data": date.today(), "idades": idades, "migrados": len(migrados_tel)}
+        except Exception:
+            # Tenta outra vez na próxima leitura
+            snap.manutencao_em = None
+            return
+    # O livro é escrito fora do lock do snapshot (o livro pode precisar de ler os clientes)
+    try:
+        registar_movimentos([novo_movimento(t, "Sistema", nota="Mudou para Normal (>19 anos)") for t in migrados_tel])
+    except Exception:
+        pass
+
+def _manutencao_medida():
+    with obter_diagnostico().execucao("manutencao_diaria"):
+        manutencao_diaria()
+    # Só reescreve o livro quando há meses para arquivar (na prática uma vez por mês)
+    with obter_diagnostico().execucao("compactar_historico"):
+        try: obter_snapshot().relatorio_compactacao = compactar_historico()
+        except Exception: pass
+
+# --- DADOS POR PÁGINA (SÓ SE LÊ O QUE A PÁGINA USA) ---
+# Cada página declara o que precisa: "nenhum", "cliente" (só o cliente com sessão iniciada),
+# "contas" (todos os clientes, só as colunas de COLUNAS_CONTA) ou "tabela" (todas as colunas).
+PAGINAS = {}
+
+def pagina(nome, dados="nenhum"):
+    def registar(funcao):
+        PAGINAS[nome] = (funcao, dados)
+        return funcao
+    return registar
+
+class DadosPagina:
+    # Entregue às páginas que precisam de dados; nada é lido até a página pedir
+    def __init__(self, declarado):
+        self.declarado = declarado
+        self._clientes = None
+
+    @property
+    def clientes(self):
+        if self.declarado not in ("tabela", "contas"): raise RuntimeError(f"Página declarada com dados '{self.declarado}' pediu a tabela")
+        if self._clientes is None: self._clientes = load_data() if self.declarado == "tabela" else load_contas()
+        return self._clientes
+
+    def cliente(self):
+        # Do snapshot (ou da projeção das contas) se estiver fresco; senão só a linha deste cliente
+        user = st.session_state['user_logado']
+        if user is None: return None
+        snap = obter_snapshot()
+        with snap.lock:
+            if snap.fresco():
+                snap.hits += 1
+                idx = snap.indice_atual().linha_telemovel(user['Telemovel'])
+                return None if idx is None else snap.df.loc[idx].copy()
+            if snap.contas_frescas():
+                snap.hits += 1
+                idx = snap.indice_contas().linha_telemovel(user['Telemovel'])
+                return None if idx is None else snap.contas[2].loc[idx].copy()
+        return obter_cliente(user['Telemovel'])
 
 # --- COMPONENTES VISUAIS ---
 def render_logo_big():
@@ -292,12 +1328,27 @@ def render_logo_big():
         <div style="display: flex; justify-content: center; margin-bottom: 10px;">
             <div style="background-color: white; border-radius: 50%; padding: 5px; width: 165px; height: 165px; display: flex; align-items: center; justify-content: center; box-shadow: 0 4px 8px rgba(0,0,0,0.2);">
                 <a href="https://kaokente.streamlit.app/" target="_self">
-                    <img src="{logo_b64}" width="160" style="border-radius: 50%;">
+                    <img src="{logo_src}" width="160" style="border-radius: 50%;">
                 </a>
             </div>
         </div>
     """, unsafe_allow_html=True)
 
+@functools.lru_cache(maxsize=1024)
+def html_premios(pontos, catalogo):
+    # Todos os cartões num só bloco, por (saldo, catálogo): mudar os prémios muda a chave
+    cartoes = []
+    for p, custo in catalogo:
+        percentagem_txt = int(min(pontos / custo, 1.0) * 100)
+        can = pontos >= custo
+        barra = ' class="completo"' if can else ''
+        cartoes.append(
+            f'<div class="premio-card"><div class="premio-topo"><div class="premio-nome">{p}</div><div class="premio-icone">{"✅" if can else "🔒"}</div></div>'
+            f'<div class="premio-pts">{pontos} / {custo} pts ({percentagem_txt}%)</div>'
+            f'<div class="premio-barra"><div{barra} style="width: {percentagem_txt}%"></div></div></div>'
+        )
+    return "".join(cartoes)
+
 def render_navigation(show_logo=True):
     st.markdown('<div class="nav-btn">', unsafe_allow_html=True)
     if st.button("⬅ VOLTAR"):
@@ -307,7 +1358,9 @@ def render_navigation(show_logo=True):
 # =========================================================
 # PÁGINA: HOME
 # =========================================================
-def pagina_home(df):
+@pagina("home")
+@medido("pagina_home")
+def pagina_home():
     render_logo_big()
     
     user = st.session_state['user_logado']
@@ -372,6 +1425,8 @@ def pagina_home(df):
 # =========================================================
 # PÁGINA: ENCOMENDAS
 # =========================================================
+@pagina("encomendas")
+@medido("pagina_encomendas")
 def pagina_encomendas():
     render_navigation(show_logo=False)
     
@@ -414,12 +1469,12 @@ def pagina_encomendas():
 # =========================================================
 # PÁGINA: LOGIN & REGISTO
 # =========================================================
-def pagina_login_menu(df):
+@pagina("login_menu", dados="contas")
+@medido("pagina_login_menu")
+def pagina_login_menu(dados):
     render_logo_big() 
     render_navigation(show_logo=False)
     
-    st.markdown("""<style>.stTabs [data-baseweb="tab-list"] button {color: white !important;}</style>""", unsafe_allow_html=True)
-    
     tab_login, tab_registo = st.tabs(["ENTRAR", "CRIAR CONTA NOVA"])
     
     with tab_login:
@@ -429,17 +1484,21 @@ def pagina_login_menu(df):
         login_pass = st.text_input("Palavra-passe", type="password")
         if st.button("ENTRAR", use_container_width=True):
             input_limpo = login_user.strip()
+            df = dados.clientes
             
-            # CORREÇÃO: Procura pelo número simples OU pelo número com o apóstrofo atrás
-            u_tel = df[((df['Telemovel'] == input_limpo) | (df['Telemovel'] == "'" + input_limpo)) & (df['Password'] == login_pass)]
-            
-            u_mail = df[(df['Email'].str.lower() == input_limpo.lower()) & (df['Password'] == login_pass)]
+            # Procura pelo telemóvel normalizado (com ou sem apóstrofo) e depois pelo e-mail
             user_found = None
-            if not u_tel.empty: user_found = u_tel.iloc[0]
-            elif not u_mail.empty: user_found = u_mail.iloc[0]
+            if 'Telemovel' in df.columns:
+                indice = obter_indice(df)
+                for idx in (indice.linha_telemovel(input_limpo), indice.linha_email(input_limpo)):
+                    if idx is not None and df.at[idx, 'Password'] == login_pass:
+                        user_found = df.loc[idx]
+                        break
             if user_found is not None:
                 st.session_state['user_logado'] = user_found
                 navegar("home")
+            # Sem tabela (Sheets em baixo e sem cópia local) não é culpa dos dados do cliente
+            elif 'Telemovel' not in df.columns: st.error("Não foi possível ler os clientes. Tenta outra vez daqui a pouco.")
             else: st.error("Dados incorretos.")
 
     with tab_registo:
@@ -468,72 +1527,56 @@ def pagina_login_menu(df):
         
         st.write("")
         if st.button("CRIAR CONTA", use_container_width=True):
+            df = dados.clientes
             if not (r_nome and r_tel and r_email and r_pass1):
                 st.error("Preenche os campos obrigatórios.")
             elif r_pass1 != r_pass2:
                 st.error("As palavras-passe não coincidem.")
-            elif r_tel in df['Telemovel'].values:
+            elif obter_indice(df).linha_telemovel(r_tel) is not None:
                 st.error("Este número de telemóvel já está registado.")
-            elif r_email in df['Email'].values and r_email != "":
+            elif r_email != "" and obter_indice(df).linha_email(r_email) is not None:
                 st.error("Este e-mail já está registado.")
             else:
-                novo = pd.DataFrame([{
+                novo = {
                     "Telemovel": "'" + str(r_tel), "Nome": r_nome, "Apelido": r_apelido,
-                    "Email": r_email, "Pontos": 0, "Historico": f"Conta criada em {datetime.now().strftime('%d/%m/%Y')}",
+                    "Email": r_email, "Pontos": 0, "Historico": "",
                     "Password": r_pass1, "Tipo": tipo_final, "Idade": idade_calc, 
                     "Nascimento": str(r_nascimento),
                     "ComidaFavorita": r_comida, "Localidade": r_local
-                }])
-                df = pd.concat([df, novo], ignore_index=True)
-                save_data(df)
-                st.balloons()
-                st.success("Conta criada! Podes fazer login.")
+                }
+                if inserir_cliente(novo):
+                    registar_movimentos([novo_movimento(r_tel, "Sistema", nota="Conta criada")])
+                    st.balloons()
+                    st.success("Conta criada! Podes fazer login.")
 
 # =========================================================
 # PÁGINA: PONTOS
 # =========================================================
-def pagina_pontos(df):
+@pagina("pontos", dados="cliente")
+@medido("pagina_pontos")
+def pagina_pontos(dados):
     render_navigation(show_logo=False)
-    user = st.session_state['user_logado']
-    user = df[df['Telemovel'] == user['Telemovel']].iloc[0]
-    
-    st.markdown(f"<h2>Área Pessoal</h2>", unsafe_allow_html=True)
-    st.markdown(f"<h3>{user['Nome']} {user['Apelido']}</h3>", unsafe_allow_html=True)
+    user = dados.cliente()
+    if user is None:
+        st.session_state['user_logado'] = None
+        navegar("home")
     
-    st.markdown(f"""
+    # A página inteira num só elemento (um delta por execução)
+    st.markdown(f"""<h2>Área Pessoal</h2>
+    <h3>{user['Nome']} {user['Apelido']}</h3>
     <div class="saldo-card">
         <div style="font-size: 1.1em; font-weight: bold; letter-spacing: 1px; color: {COR_BOTAO_FUNDO} !important;">SALDO DISPONÍVEL</div>
         <div style="color: {COR_BOTAO_FUNDO} !important; font-size: 4em; font-weight: 900;">{user['Pontos']}</div>
         <div style="color: #f68625 !important;">pontos acumulados</div>
     </div>
-    """, unsafe_allow_html=True)
-    
-    st.write("🎁 **Progresso para recompensas:**")
-    for p, custo in PREMIOS_PONTOS.items():
-        percentagem = min(user['Pontos'] / custo, 1.0)
-        percentagem_txt = int(percentagem * 100)
-        can = percentagem >= 1.0
-        icon = '✅' if can else '🔒'
-        cor_barra = COR_VERDE_ESCURO if can else COR_BOTAO_FUNDO
-        
-        st.markdown(f"""
-        <div style="background-color: white; border-radius: 15px; padding: 15px; margin-bottom: 15px; box-shadow: 0 2px 4px rgba(0,0,0,0.1);">
-            <div style="display: flex; justify-content: space-between; align-items: center; margin-bottom: 5px;">
-                <div style="font-weight: bold; color: {COR_CASTANHO}; font-size: 1.1em;">{p}</div>
-                <div style="font-size: 1.5em;">{icon}</div>
-            </div>
-            <div style="color: #666; font-size: 0.9em; margin-bottom: 8px; text-align: left;">
-                {user['Pontos']} / {custo} pts ({percentagem_txt}%)
-            </div>
-            <div style="width: 100%; background-color: #eee; border-radius: 10px; height: 12px; overflow: hidden;">
-                <div style="width: {percentagem_txt}%; background-color: {cor_barra}; height: 100%; border-radius: 10px; transition: width 0.5s;"></div>
-            </div>
-        </div>
-        """, unsafe_allow_html=True)
+    <p><strong>🎁 Progresso para recompensas:</strong></p>
+    {html_premios(int(user['Pontos']), tuple(PREMIOS_PONTOS.items()))}""", unsafe_allow_html=True)
 
 # =========================================================
 # PÁGINA: ADMIN
 # =========================================================
+@pagina("admin_login")
+@medido("pagina_admin_login")
 def pagina_admin_login():
     render_navigation(show_logo=False)
     st.markdown("<h2>Acesso Staff</h2>", unsafe_allow_html=True)
@@ -544,110 +1587,266 @@ def pagina_admin_login():
     elif pwd:
         st.error("Errado")
 
-def pagina_admin_panel(df):
-    st.markdown('<div class="nav-btn">', unsafe_allow_html=True)
-    if st.button("⬅ Sair"): 
-        st.session_state['admin_ok'] = False
-        navegar("home")
-    st.markdown('</div>', unsafe_allow_html=True)
-        
-    st.title("🔐 Gestão")
+# --- PAINEL: FRAGMENTOS (SÓ A PARTE QUE MUDOU VOLTA A CORRER) ---
+# A pesquisa e cada separador correm sozinhos com o snapshot da última execução completa (sem load_data).
+# Só uma alteração guardada pede uma execução completa, para todo o painel ver os dados novos.
+def fragmento(nome):
+    # st.fragment que, quando corre sozinho, fica no diagnóstico como execução própria
+    def decorador(funcao):
+        @functools.wraps(funcao)
+        def medida(*args, **kwargs):
+            with obter_diagnostico().execucao(nome):
+                return funcao(*args, **kwargs)
+        return st.fragment(medida)
+    return decorador
+
+def concluido(mensagem):
+    # O aviso passa a execução completa e aparece junto ao cliente
+    st.session_state['aviso_painel'] = mensagem
+    st.rerun()
+
+@fragmento("painel_pesquisa")
+def painel_pesquisa(df, indice):
     q = st.text_input("🔍 Pesquisar")
-    df_show = df.copy()
-    if q: df_show = df[df['Nome'].str.lower().str.contains(q.lower()) | df['Telemovel'].str.contains(q)]
-    opcoes = df_show['Telemovel'].tolist()
-    sel = st.selectbox("Selecionar Cliente", opcoes, format_func=lambda x: f"{df[df['Telemovel']==x]['Nome'].values[0]} {df[df['Telemovel']==x]['Apelido'].values[0]} ({x})") if opcoes else None
+    # Só a página atual dos resultados vai para o browser
+    resultados = indice.pesquisar(q)
+    paginas = max(1, math.ceil(len(resultados) / RESULTADOS_POR_PAGINA))
+    pagina = st.number_input(f"Página (de {paginas})", min_value=1, max_value=paginas, value=1, key=f"pagina_pesquisa_{q}") if paginas > 1 else 1
+    st.caption(f"{len(resultados)} clientes encontrados")
+    opcoes = resultados[(pagina - 1) * RESULTADOS_POR_PAGINA:pagina * RESULTADOS_POR_PAGINA]
+    sel = st.selectbox("Selecionar Cliente", opcoes, format_func=lambda x: indice.rotulos.get(x, x)) if opcoes else None
+    if aviso := st.session_state.pop('aviso_painel', None): st.success(aviso)
     
     if sel:
-        d = df[df['Telemovel'] == sel].iloc[0]
-        ga, gb = calcular_metricas(d['Historico'])
+        idx = indice.linha_telemovel(sel)
+        d = df.loc[idx]
+        try: ga, gb = calcular_metricas(carregar_movimentos().movimentos(sel))
+        except Exception: ga, gb = 0.0, 0.0
         st.info(f"**{d['Nome']} {d['Apelido']}** | {d['Tipo']} | {d['Idade']} Anos")
         c1, c2, c3 = st.columns(3)
         c1.metric("Pontos", d['Pontos'])
         c2.metric("Mês actual", f"{ga}€")
         c3.metric("Mês passado", f"{gb}€")
         
-        st.markdown("""<style>.stTabs [data-baseweb="tab-list"] button {color: white !important;}</style>""", unsafe_allow_html=True)
-        t1, t2, t3, t4 = st.tabs(["💰 Lançar", "🎁 Resgatar", "✏️ Editar", "📊 Tabela"])
+        t1, t2, t3, t5, t4 = st.tabs(["💰 Lançar", "🎁 Resgatar", "✏️ Editar", "📜 Histórico", "📊 Tabela"])
+        with t1: painel_lancar(df, idx, sel, d['Tipo'])
+        with t2: painel_resgatar(df, idx, sel)
+        with t3: painel_editar(df, idx, d)
+        with t5: painel_historico(sel)
+        with t4: painel_tabela(df)
+
+@fragmento("painel_lancar")
+def painel_lancar(df, idx, sel, tipo):
+    v = st.number_input("Valor €", step=0.5)
+    pg = calcular_pontos_ganhos(v, tipo)
+    st.write(f"Ganha: **{pg}** pontos")
+    if st.button("Lançar", use_container_width=True):
+        try:
+            movimentar_pontos(df, idx, pg, novo_movimento(sel, "Compra", valor=v, pontos=pg))
+            concluido("Pontos atribuídos com sucesso")
+        except Exception as e: st.error(f"Erro: {e}")
+
+@fragmento("painel_resgatar")
+def painel_resgatar(df, idx, sel):
+    pr = st.selectbox("Prémio", list(PREMIOS_PONTOS.keys()))
+    if st.button("Resgatar", use_container_width=True):
+        custo = PREMIOS_PONTOS[pr]
+        # O saldo é confirmado no armazenamento no momento do resgate
+        try:
+            movimentar_pontos(df, idx, -custo, novo_movimento(sel, "Resgate", pontos=-custo, premio=pr))
+            concluido("Produto resgatado com sucesso")
+        except SaldoInsuficiente: st.error("Saldo insuficiente")
+        except Exception as e: st.error(f"Erro: {e}")
+
+@fragmento("painel_editar")
+def painel_editar(df, idx, d):
+    st.markdown("### Editar Dados")
+    with st.form("edit"):
+        c_a, c_b = st.columns(2)
+        with c_a: en = st.text_input("Nome", value=d['Nome'])
+        with c_b: ea = st.text_input("Apelido", value=d['Apelido'])
+        c_c, c_d = st.columns(2)
+        with c_c: em = st.text_input("Email", value=d['Email'])
+        with c_d: etel = st.text_input("Telemóvel", value=d['Telemovel'])
+        et = st.selectbox("Tipo", ["Normal", "Estudante"], index=0 if d['Tipo']=="Normal" else 1)
+        
+        # Edit Nascimento
+        try:
+            data_atual = datetime.strptime(str(d['Nascimento']), "%Y-%m-%d").date()
+        except:
+            data_atual = date.today()
+        enasc = st.date_input("Data Nascimento", value=data_atual, format="DD/MM/YYYY")
         
-        with t1:
-            v = st.number_input("Valor €", step=0.5)
-            pg = calcular_pontos_ganhos(v, d['Tipo'])
-            st.write(f"Ganha: **{pg}** pontos")
-            if st.button("Lançar", use_container_width=True):
-                idx = df[df['Telemovel']==sel].index[0]
-                df.at[idx, 'Pontos'] += pg
-                df.at[idx, 'Historico'] = f"{datetime.now().strftime('%d/%m/%Y %H:%M')} | Compra {v}€ | +{pg} pts\n" + str(df.at[idx, 'Historico'])
-                save_data(df)
-                st.success("Pontos atribuídos com sucesso")
-        with t2:
-            pr = st.selectbox("Prémio", list(PREMIOS_PONTOS.keys()))
-            if st.button("Resgatar", use_container_width=True):
-                custo = PREMIOS_PONTOS[pr]
-                if d['Pontos'] >= custo:
-                    idx = df[df['Telemovel']==sel].index[0]
-                    df.at[idx, 'Pontos'] -= custo
-                    df.at[idx, 'Historico'] = f"{datetime.now().strftime('%d/%m/%Y %H:%M')} | Resgate {pr} | -{custo} pts\n" + str(df.at[idx, 'Historico'])
-                    save_data(df)
-                    st.success("Produto resgatado com sucesso")
-                else: st.error("Saldo insuficiente")
-        with t3:
-            st.markdown("### Editar Dados")
-            with st.form("edit"):
-                c_a, c_b = st.columns(2)
-                with c_a: en = st.text_input("Nome", value=d['Nome'])
-                with c_b: ea = st.text_input("Apelido", value=d['Apelido'])
-                c_c, c_d = st.columns(2)
-                with c_c: em = st.text_input("Email", value=d['Email'])
-                with c_d: etel = st.text_input("Telemóvel", value=d['Telemovel'])
-                et = st.selectbox("Tipo", ["Normal", "Estudante"], index=0 if d['Tipo']=="Normal" else 1)
-                
-                # Edit Nascimento
+        ep = st.number_input("Pontos (Manual)", value=int(d['Pontos']))
+        eloc = st.text_input("Localidade", value=d['Localidade'])
+        efood = st.text_input("Comida Fav.", value=d['ComidaFavorita'])
+        
+        if st.form_submit_button("💾 Guardar", use_container_width=True):
+            novos = {
+                'Nome': en, 'Apelido': ea, 'Email': em, 'Telemovel': "'" + etel,
+                'Tipo': et, 'Nascimento': str(enasc), 'Pontos': ep, 'Localidade': eloc, 'ComidaFavorita': efood,
+                # Recalcular idade ao editar
+                'Idade': calcular_idade(enasc)
+            }
+            # Só envia as células que mudaram
+            campos = {c: v for c, v in novos.items() if str(df.at[idx, c]) != str(v)}
+            tel_antigo = df.at[idx, 'Telemovel']
+            if c_tel := campos.get('Telemovel'):
+                if normalizar_telemovel(c_tel) == normalizar_telemovel(tel_antigo): del campos['Telemovel']
+            
+            # Com erro fica o aviso do erro: nem confirmação nem livro renomeado
+            if atualizar_cliente(df, idx, campos):
+                if 'Telemovel' in campos: renomear_cliente_movimentos(tel_antigo, campos['Telemovel'])
+                concluido("Guardado")
+    st.divider()
+    with st.expander("🗑️ Apagar Cliente"):
+        st.markdown(f"""
+        <div style="background-color: #ffcdd2; padding: 20px; border-radius: 10px; border: 3px solid #b71c1c; text-align: center;">
+            <h3 style="color: #b71c1c !important;">⚠️  ATENÇÃO ⚠️</h3>
+            <p style="color: black; font-weight: bold;">Este cliente tem:</p>
+            <h1 style="color: #b71c1c !important; font-size: 3em !important;">{d['Pontos']} PONTOS</h1>
+            <p style="color: black;">MEMORIZE ESTE VALOR ANTES DE APAGAR!</p>
+        </div>""", unsafe_allow_html=True)
+        if st.button("CONFIRMAR: APAGAR PERMANENTEMENTE", use_container_width=True):
+            if apagar_cliente(df, idx): concluido("Apagado.")
+
+@fragmento("painel_historico")
+def painel_historico(sel):
+    try:
+        mov = carregar_movimentos().movimentos(sel)
+        st.caption(f"Últimos {HISTORICO_MESES_RECENTES} meses em detalhe; os anteriores resumidos por mês")
+        st.dataframe(mov.drop(columns='Mes').iloc[::-1], use_container_width=True, hide_index=True)
+    except Exception as e:
+        st.error(f"Erro: {e}")
+    # O arquivo só é lido quando pedido
+    if st.button("📦 Ver histórico arquivado", use_container_width=True):
+        try:
+            arquivo = ler_arquivo_cliente(sel)
+            if arquivo is None: st.caption("Sem movimentos arquivados.")
+            else: st.dataframe(arquivo.drop(columns='Mes').iloc[::-1], use_container_width=True, hide_index=True)
+        except Exception as e:
+            st.error(f"Erro: {e}")
+
+@fragmento("painel_tabela")
+def painel_tabela(df):
+    st.warning("Esta área é restrita. O que andas a fazer aqui?")
+    pass_master = st.text_input("Palavra-passe", type="password")
+    if pass_master == "noronha":
+        colunas = st.multiselect("Colunas", COLUNAS_CLIENTES, default=TABELA_COLUNAS_OMISSAO)
+        c_t, c_l = st.columns(2)
+        tipos = c_t.multiselect("Tipo", ["Normal", "Estudante"])
+        localidades = c_l.multiselect("Localidade", sorted(set(df['Localidade'].tolist()) - {""}))
+        maximo = int(df['Pontos'].max()) if len(df) else 0
+        pontos = st.slider("Pontos", 0, maximo, (0, maximo)) if maximo > 0 else None
+        c_o, c_a = st.columns(2)
+        ordem = c_o.selectbox("Ordenar por", ["—"] + TABELA_ORDENACAO)
+        ascendente = c_a.toggle("Ascendente", value=True)
+        linhas = filtrar_tabela(df, tipos, localidades, pontos, None if ordem == "—" else ordem, ascendente)
+        
+        paginas = max(1, math.ceil(len(linhas) / TABELA_POR_PAGINA))
+        pag = st.number_input(f"Página (de {paginas})", min_value=1, max_value=paginas, value=1, key=f"pagina_tabela_{paginas}") if paginas > 1 else 1
+        st.caption(f"{len(linhas)} clientes")
+        if colunas:
+            st.dataframe(df.loc[linhas[(pag - 1) * TABELA_POR_PAGINA:pag * TABELA_POR_PAGINA], colunas], use_container_width=True, hide_index=True)
+            st.download_button("⬇️ Exportar CSV", lambda: exportar_csv(df, linhas, colunas),
+                               file_name=f"clientes_{datetime.now():%Y%m%d_%H%M}.csv", mime="text/csv")
+
+@pagina("admin_panel", dados="tabela")
+@medido("pagina_admin_panel")
+def pagina_admin_panel(dados):
+    df = dados.clientes
+    st.markdown('<div class="nav-btn">', unsafe_allow_html=True)
+    if st.button("⬅ Sair"): 
+        st.session_state['admin_ok'] = False
+        navegar("home")
+    st.markdown('</div>', unsafe_allow_html=True)
+        
+    st.title("🔐 Gestão")
+    snap = obter_snapshot()
+    if snap.local:
+        st.warning(f"Sem ligação ao Sheets: dados da cópia local{f' de {snap.lido_em:%d/%m %H:%M}' if snap.lido_em else ''}. Os lançamentos ficam na fila até a folha voltar.")
+    st.caption(f"Cache: versão {snap.versao} · {snap.hits} hits / {snap.misses} misses")
+    if rel := snap.relatorio_manutencao:
+        st.caption(f"Manutenção de {rel['data'].strftime('%d/%m/%Y')}: {rel['idades']} idades atualizadas, {rel['migrados']} clientes passaram a Normal (>19 anos)")
+    if (rel := snap.relatorio_compactacao) and (rel['arquivados'] or rel['historicos']):
+        st.caption(f"Histórico compactado: {rel['arquivados']} movimentos arquivados em {rel['resumos']} resumos mensais, {rel['historicos']} células Historico limpas")
+    if fila_ativa() or obter_fila().pendentes():
+        fila = obter_fila()
+        estado = f" · {fila.falhas} falhas seguidas, nova tentativa em {fila.espera:.0f}s ({fila.ultimo_erro})" if fila.falhas else ""
+        st.caption(f"Fila de escrita: {fila.pendentes()} pendentes · {fila.enviados} lotes enviados{estado}")
+    if obter_armazenamento().nome == "sqlite":
+        with st.expander("🗄️ Armazenamento local"):
+            st.caption(f"Motor: SQLite ({obter_armazenamento().caminho})")
+            c_s, c_i = st.columns(2)
+            if c_s.button("⬆️ Sincronizar com Sheets", use_container_width=True):
+                try: st.success(f"{sincronizar_para_sheets()} clientes enviados para o Sheets")
+                except Exception as e: st.error(f"Erro: {e}")
+            if c_i.button("⬇️ Importar do Sheets", use_container_width=True):
+                try: st.success(f"{importar_de_sheets()} clientes importados")
+                except Exception as e: st.error(f"Erro: {e}")
+    if len(LOJAS) > 1:
+        with st.expander(f"🏪 Outras lojas (esta: {LOJA})"):
+            tel_outra = st.text_input("Telemóvel do cliente", key="tel_outra_loja")
+            if st.button("Procurar noutras lojas", use_container_width=True) and tel_outra:
                 try:
-                    data_atual = datetime.strptime(str(d['Nascimento']), "%Y-%m-%d").date()
-                except:
-                    data_atual = date.today()
-                enasc = st.date_input("Data Nascimento", value=data_atual, format="DD/MM/YYYY")
-                
-                ep = st.number_input("Pontos (Manual)", value=int(d['Pontos']))
-                eloc = st.text_input("Localidade", value=d['Localidade'])
-                efood = st.text_input("Comida Fav.", value=d['ComidaFavorita'])
-                
-                if st.form_submit_button("💾 Guardar", use_container_width=True):
-                    idx = df[df['Telemovel']==sel].index[0]
-                    df.at[idx, 'Nome'] = en; df.at[idx, 'Apelido'] = ea; df.at[idx, 'Email'] = em; df.at[idx, 'Telemovel'] = "'" + etel
-                    df.at[idx, 'Tipo'] = et; df.at[idx, 'Nascimento'] = str(enasc); df.at[idx, 'Pontos'] = ep; df.at[idx, 'Localidade'] = eloc; df.at[idx, 'ComidaFavorita'] = efood
-                    
-                    # Recalcular idade ao editar
-                    df.at[idx, 'Idade'] = calcular_idade(enasc)
-                    
-                    save_data(df); st.success("Guardado")
-            st.divider()
-            with st.expander("🗑️ Apagar Cliente"):
-                st.markdown(f"""
-                <div style="background-color: #ffcdd2; padding: 20px; border-radius: 10px; border: 3px solid #b71c1c; text-align: center;">
-                    <h3 style="color: #b71c1c !important;">⚠️  ATENÇÃO ⚠️</h3>
-                    <p style="color: black; font-weight: bold;">Este cliente tem:</p>
-                    <h1 style="color: #b71c1c !important; font-size: 3em !important;">{d['Pontos']} PONTOS</h1>
-                    <p style="color: black;">MEMORIZE ESTE VALOR ANTES DE APAGAR!</p>
-                </div>""", unsafe_allow_html=True)
-                if st.button("CONFIRMAR: APAGAR PERMANENTEMENTE", use_container_width=True):
-                    idx = df[df['Telemovel']==sel].index[0]
-                    df = df.drop(idx)
-                    save_data(df)
-                    st.success("Apagado.")
-                    st.rerun()
-        with t4:
-            st.warning("Esta área é restrita. O que andas a fazer aqui?")
-            pass_master = st.text_input("Palavra-passe", type="password")
-            if pass_master == "noronha": st.dataframe(df)
+                    encontrados = procurar_noutras_lojas(tel_outra)
+                    if encontrados.empty: st.caption("Cliente não encontrado noutras lojas.")
+                    else: st.dataframe(encontrados, use_container_width=True, hide_index=True)
+                except Exception as e:
+                    st.error(f"Erro: {e}")
+    with st.expander("🩺 Diagnóstico"):
+        leituras = obter_leituras()
+        st.caption(f"Leituras do Sheets: {leituras.leituras} pedidos · {leituras.partilhadas} partilhadas · {leituras.repetidas} repetidas após 429 · {leituras.desistencias} desistências")
+        registos = obter_diagnostico().registos()
+        por_execucao, por_op = percentis_diagnostico(registos)
+        if por_execucao is None:
+            st.caption("Ainda sem execuções registadas.")
+        else:
+            st.caption(f"Últimas {len(registos)} execuções (ms; api, KB e linhas são médias por execução)")
+            st.dataframe(por_execucao, use_container_width=True)
+            if por_op is not None: st.dataframe(por_op, use_container_width=True)
+            st.download_button("⬇️ Exportar (JSON Lines)", "\n".join(json.dumps(r, ensure_ascii=False) for r in registos),
+                               file_name=f"diagnostico_{datetime.now():%Y%m%d_%H%M}.jsonl", mime="application/x-ndjson")
+    with st.expander("📥 Importar vendas da caixa"):
+        st.caption("CSV ou XLSX com telemóvel, valor e data/hora de cada venda")
+        ficheiro = st.file_uploader("Exportação da caixa", type=["csv", "xlsx"])
+        if ficheiro is not None:
+            try:
+                aceites, rejeitados = preparar_importacao(ler_exportacao_caixa(ficheiro), df, carregar_movimentos().df, obter_indice(df))
+                c1, c2, c3 = st.columns(3)
+                c1.metric("Vendas a importar", len(aceites))
+                c2.metric("Pontos", int(aceites['Pontos'].sum()))
+                c3.metric("Rejeitadas", len(rejeitados))
+                st.dataframe(aceites.drop(columns='idx').head(200), use_container_width=True, hide_index=True)
+                if len(rejeitados):
+                    st.markdown("**Rejeitadas / sem cliente**")
+                    st.dataframe(rejeitados, use_container_width=True, hide_index=True)
+                if len(aceites) and st.button("✅ Confirmar importação", use_container_width=True):
+                    clientes, pontos, falhas = aplicar_importacao(aceites)
+                    st.success(f"{len(aceites) if not falhas else 'Parte das'} vendas importadas: {pontos} pontos para {clientes} clientes")
+                    if falhas: st.warning(f"{len(falhas)} clientes ficaram por atualizar (importar o ficheiro outra vez trata só destes): {'; '.join(falhas[:10])}")
+            except Exception as e:
+                st.error(f"Erro: {e}")
+    with st.expander("📈 Resumo"):
+        try:
+            r = obter_resumo(df)
+            c1, c2 = st.columns(2)
+            c1.metric("Faturação mês actual", f"{r['total']:.2f}€", delta=f"{r['total'] - r['total_anterior']:.2f}€")
+            c2.metric("Mês passado", f"{r['total_anterior']:.2f}€")
+            c3, c4 = st.columns(2)
+            c3.metric("Pontos emitidos", r['emitidos'])
+            c4.metric("Pontos resgatados", r['resgatados'])
+            st.markdown("**Normal / Estudante**")
+            st.dataframe(r['por_tipo'], use_container_width=True)
+            st.markdown("**Top clientes do mês**")
+            st.dataframe(r['topo'], use_container_width=True)
+        except Exception as e:
+            st.error(f"Erro: {e}")
+    painel_pesquisa(df, obter_indice(df))
 
 # --- MAIN LOOP ---
-df = load_data()
 p = st.session_state['pagina']
-if p == "home": pagina_home(df)
-elif p == "encomendas": pagina_encomendas()
-elif p == "login_menu": pagina_login_menu(df)
-elif p == "pontos": pagina_pontos(df)
-elif p == "admin_login": pagina_admin_login()
-elif p == "admin_panel": pagina_admin_panel(df)
\ No newline at end of file
+with obter_diagnostico().execucao(p):
+    funcao, dados = PAGINAS[p]
+    if dados == "nenhum": funcao()
+    else: funcao(DadosPagina(dados))
\ No newline at end of file
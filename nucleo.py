@@ -0,0 +1,840 @@
+# Núcleo da app de fidelidade: regras de pontos, clientes, livro de movimentos, importação da caixa e
+# motores de armazenamento. Não importa o Streamlit: serve a app (fidelidade.py) e as tarefas sem
+# interface (tarefas.py), e pode ser importado sem efeitos.
+import functools
+import io
+import os
+import random
+import sqlite3
+import threading
+import time
+import unicodedata
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from datetime import datetime, date
+
+import pandas as pd
+
+# --- LÓGICA DE NEGÓCIO ---
+COLUNAS_CLIENTES = ["Telemovel", "Nome", "Apelido", "Email", "Pontos", "Historico", "Password", "Tipo", "Idade", "Nascimento", "ComidaFavorita", "Localidade"]
+# Colunas quentes (login, saldo e pesquisa); o resto do perfil e o histórico só são lidos quando a página precisa
+COLUNAS_CONTA = ["Telemovel", "Nome", "Apelido", "Email", "Password", "Pontos", "Tipo"]
+
+def sem_acentos(serie):
+    # "João" → "joao", para pesquisas que ignoram acentos e maiúsculas (cada valor distinto só uma vez)
+    serie = serie.fillna("").astype(str)
+    return serie.map({v: (v if v.isascii() else unicodedata.normalize('NFKD', v).encode('ascii', 'ignore').decode('ascii')).lower() for v in serie.unique().tolist()})
+
+def normalizar_telemovel(tel):
+    return str(tel).strip().lstrip("'").removesuffix(".0") if tel is not None else ""
+
+def calcular_idade(data_nascimento):
+    if not data_nascimento: return 0
+    if isinstance(data_nascimento, str):
+        try:
+            data_nascimento = datetime.strptime(data_nascimento, "%Y-%m-%d").date()
+        except:
+            return 0
+    hoje = date.today()
+    return hoje.year - data_nascimento.year - ((hoje.month, hoje.day) < (data_nascimento.month, data_nascimento.day))
+
+class SaldoInsuficiente(Exception):
+    pass
+
+class ConflitoPontos(Exception):
+    pass
+
+TENTATIVAS_PONTOS = 5
+
+def somar_pontos(motor, idx, telemovel, delta, tentativas=TENTATIVAS_PONTOS):
+    # Soma delta ao saldo atual no armazenamento (nunca a um valor lido antes) com compare-and-swap.
+    # Se outro terminal mudou o saldo entre a leitura e a escrita, volta a tentar.
+    for tentativa in range(tentativas):
+        atual = motor.ler_pontos(idx, telemovel)
+        novo = atual + delta
+        if novo < 0: raise SaldoInsuficiente(f"Saldo insuficiente ({atual} pontos)")
+        if motor.cas_pontos(idx, telemovel, atual, novo): return novo
+        time.sleep(0.05 * 2 ** tentativa)
+    raise ConflitoPontos("Saldo alterado noutro terminal, tenta outra vez")
+
+PREMIOS_PONTOS = {
+    "Dose batatas": 300,
+    "Cachorro 3K": 450,
+    "Hambúrguer Kão Kente": 500,
+    "Kebab de frango": 550,
+    "Baconcheeseburger com ovo": 700,
+    "Bitoque de frango": 950
+}
+
+MULT_NORMAL = 5.0
+MULT_ESTUDANTE = 7.5
+
+def calcular_pontos_ganhos(valor, tipo):
+    mult = MULT_ESTUDANTE if tipo == "Estudante" else MULT_NORMAL
+    return int(int(valor) * mult)
+
+def calcular_pontos_ganhos_lote(valores, tipos):
+    # A mesma regra, para colunas inteiras (importação de vendas)
+    mult = tipos.eq("Estudante").map({True: MULT_ESTUDANTE, False: MULT_NORMAL})
+    return (valores.astype(int) * mult).astype(int)
+
+def calcular_metricas(movs, hoje=None):
+    # movs: movimentos de um cliente no livro (colunas tipadas)
+    mes = pd.Period(hoje or datetime.now(), 'M')
+    # Só séries (sem copiar o DataFrame filtrado)
+    compras = movs['Tipo'] == 'Compra'
+    curr = movs['Valor'][compras & (movs['Mes'] == mes)].sum()
+    prev = movs['Valor'][compras & (movs['Mes'] == mes - 1)].sum()
+    return float(curr), float(prev)
+
+# --- FUNÇÃO DE ATUALIZAÇÃO AUTOMÁTICA DE IDADE E TIPO ---
+def verificar_atualizacoes_automaticas(df, hoje=None):
+    # Uma só passagem vetorizada sobre a coluna Nascimento
+    hoje = hoje or date.today()
+    nasc = pd.to_datetime(df['Nascimento'], format="%Y-%m-%d", errors='coerce')
+    validas = nasc.notna()
+    ainda_nao_fez_anos = (nasc.dt.month > hoje.month) | ((nasc.dt.month == hoje.month) & (nasc.dt.day > hoje.day))
+    nova_idade = (hoje.year - nasc.dt.year - ainda_nao_fez_anos.astype(int)).fillna(0).astype(int)
+    
+    # Atualiza Idade
+    mudou_idade = validas & (df['Idade'] != nova_idade)
+    df.loc[mudou_idade, 'Idade'] = nova_idade[mudou_idade]
+    
+    # Se passou dos 19 anos, deixa de ser estudante (o registo vai para o livro de movimentos)
+    migrar = validas & (df['Tipo'] == 'Estudante') & (nova_idade > 19)
+    df.loc[migrar, 'Tipo'] = 'Normal'
+    
+    return df, df.index[mudou_idade | migrar], int(migrar.sum())
+
+def alteracoes_manutencao(df, hoje=None):
+    # Só as células que mudam ({idx: campos}) e os telemóveis de quem deixou de ser estudante
+    novo, alteradas, _ = verificar_atualizacoes_automaticas(df.copy(), hoje)
+    alteracoes = {}
+    for i in alteradas:
+        campos = {c: novo.at[i, c] for c in ('Idade', 'Tipo') if novo.at[i, c] != df.at[i, c]}
+        if campos: alteracoes[i] = campos
+    return alteracoes, [df.at[i, 'Telemovel'] for i, campos in alteracoes.items() if 'Tipo' in campos]
+
+def normalizar_clientes(df, colunas=COLUNAS_CLIENTES):
+    # colunas: as que a leitura trouxe (uma leitura projetada não ganha as outras)
+    df['Telemovel'] = df['Telemovel'].astype(str).replace('nan', '').str.replace(r'\.0$', '', regex=True)
+    cols_str = [c for c in ['Nome', 'Apelido', 'Email', 'Historico', 'Password', 'Tipo', 'ComidaFavorita', 'Localidade', 'Nascimento'] if c in colunas]
+    for c in cols_str:
+        if c not in df.columns: df[c] = ""
+        df[c] = df[c].astype(str).replace('nan', '')
+    
+    if 'Pontos' in colunas:
+        if 'Pontos' not in df.columns: df['Pontos'] = 0
+        df['Pontos'] = pd.to_numeric(df['Pontos'], errors='coerce').fillna(0).astype(int)
+    
+    if 'Idade' in colunas:
+        if 'Idade' not in df.columns: df['Idade'] = 0
+        df['Idade'] = pd.to_numeric(df['Idade'], errors='coerce').fillna(0).astype(int)
+    return df
+
+def valor_celula(v):
+    if hasattr(v, 'item'): v = v.item()
+    return v
+
+# --- ÍNDICE DE CLIENTES (TELEMÓVEL / EMAIL → LINHA) ---
+class IndiceClientes:
+    def __init__(self, df, versao=None):
+        self.versao = versao
+        # Em caso de duplicados fica a primeira linha, como nas pesquisas antigas
+        tels = df['Telemovel'].map(normalizar_telemovel)
+        self.por_telemovel = dict(zip(tels[::-1].tolist(), df.index[::-1].tolist()))
+        self.por_telemovel.pop("", None)
+        emails = df['Email'].str.strip().str.lower()
+        self.por_email = dict(zip(emails[::-1].tolist(), df.index[::-1].tolist()))
+        self.por_email.pop("", None)
+        self.rotulos = {t: f"{n} {a} ({t})" for t, n, a in zip(df['Telemovel'].tolist(), df['Nome'].tolist(), df['Apelido'].tolist())}
+        
+        # Pesquisa: um texto por cliente, sem acentos nem maiúsculas; o espaço marca o início de cada palavra
+        self.telemoveis = df['Telemovel'].reset_index(drop=True)
+        self._tels = tels.reset_index(drop=True)
+        nomes = (sem_acentos(df['Nome']) + " " + sem_acentos(df['Apelido'])).reset_index(drop=True)
+        self._texto = " " + nomes + " " + sem_acentos(df['Email']).reset_index(drop=True) + " " + self._tels
+        ordem = nomes.sort_values(kind='stable').index
+        self._ordem_nome = pd.Series(range(len(ordem)), index=ordem).sort_index()
+
+    def linha_telemovel(self, tel):
+        return self.por_telemovel.get(normalizar_telemovel(tel))
+
+    def linha_email(self, email):
+        return self.por_email.get(str(email).strip().lower())
+
+    def pesquisar(self, q):
+        # Todos os termos têm de aparecer. Primeiro o telemóvel exato, depois início de palavra, por fim a meio
+        termos = sem_acentos(pd.Series([q]))[0].split()
+        if not termos: return self.telemoveis.iloc[self._ordem_nome.argsort()].tolist()
+        encontrado = pd.Series(True, index=self._texto.index)
+        rank = pd.Series(0, index=self._texto.index)
+        for t in termos:
+            encontrado &= self._texto.str.contains(t, regex=False)
+            rank += ~self._texto.str.contains(" " + t, regex=False)
+        rank[self._tels == normalizar_telemovel(q)] = -1
+        ordem = pd.DataFrame({'rank': rank, 'nome': self._ordem_nome})[encontrado].sort_values(['rank', 'nome'])
+        return self.telemoveis.iloc[ordem.index].tolist()
+
+# --- LIVRO DE MOVIMENTOS (HISTÓRICO ESTRUTURADO) ---
+FOLHA_MOVIMENTOS = "Movimentos"
+FOLHA_ARQUIVO = "Arquivo"
+COLUNAS_MOVIMENTOS = ["Cliente", "Data", "Tipo", "Valor", "Pontos", "Premio", "Nota"]
+FORMATO_DATA_MOVIMENTO = "%Y-%m-%d %H:%M"
+
+def novo_movimento(cliente, tipo, valor=0.0, pontos=0, premio="", nota="", data=None):
+    return {
+        "Cliente": normalizar_telemovel(cliente), "Data": data or datetime.now().replace(second=0, microsecond=0),
+        "Tipo": tipo, "Valor": float(valor), "Pontos": int(pontos), "Premio": premio, "Nota": nota
+    }
+
+def normalizar_movimentos(df):
+    for c in COLUNAS_MOVIMENTOS:
+        if c not in df.columns: df[c] = ""
+    df['Cliente'] = df['Cliente'].fillna("").map(normalizar_telemovel)
+    df['Data'] = pd.to_datetime(df['Data'], format=FORMATO_DATA_MOVIMENTO, errors='coerce')
+    for c in ['Tipo', 'Premio', 'Nota']:
+        df[c] = df[c].fillna("").astype(str)
+    df['Valor'] = pd.to_numeric(df['Valor'], errors='coerce').fillna(0.0).astype(float)
+    df['Pontos'] = pd.to_numeric(df['Pontos'], errors='coerce').fillna(0).astype(int)
+    df['Mes'] = df['Data'].dt.to_period('M')
+    return df[COLUNAS_MOVIMENTOS + ['Mes']]
+
+def linhas_movimentos(df):
+    datas = df['Data'].dt.strftime(FORMATO_DATA_MOVIMENTO).fillna("")
+    return [[c, d, t, float(v), int(p), pr, n] for c, d, t, v, p, pr, n in zip(*(s.tolist() for s in (df['Cliente'], datas, df['Tipo'], df['Valor'], df['Pontos'], df['Premio'], df['Nota'])))]
+
+def converter_historico(df):
+    # Converte o texto antigo ("dd/mm/YYYY HH:MM | Compra 12.5€ | +62 pts") em movimentos tipados
+    linhas = df[['Telemovel']].assign(Linha=df['Historico'].fillna("").astype(str).str.split('\n')).explode('Linha').reset_index(drop=True)
+    linhas['Linha'] = linhas['Linha'].fillna("").str.strip()
+    linhas = linhas[linhas['Linha'] != ""]
+    partes = linhas['Linha'].str.extract(r'^(?P<data>[^|]*?)\s*\|\s*(?P<desc>[^|]*?)\s*(?:\|\s*(?P<pts>[+-]?\d+)\s*pts)?$')
+    criada = linhas['Linha'].str.extract(r'^Conta criada em (\d{2}/\d{2}/\d{4})')[0]
+    
+    # Linhas antigas sem ano ("dd/mm HH:MM") contam como sendo deste ano, como antes
+    data_txt = partes['data'].fillna(criada).fillna("").str.replace(r'^(\d{2}/\d{2}) (\d{2}:\d{2})$', rf'\1/{datetime.now().year} \2', regex=True)
+    data = pd.to_datetime(data_txt, format='%d/%m/%Y %H:%M', errors='coerce').fillna(pd.to_datetime(data_txt, format='%d/%m/%Y', errors='coerce'))
+    
+    desc = partes['desc'].fillna("")
+    tipo = pd.Series("Sistema", index=linhas.index)
+    tipo[desc.str.startswith("Compra")] = "Compra"
+    tipo[desc.str.startswith("Resgate")] = "Resgate"
+    valor = pd.to_numeric(desc.where(tipo == "Compra", "").str.replace("Compra", "").str.replace("€", "").str.strip(), errors='coerce')
+    
+    mov = pd.DataFrame({
+        "Cliente": linhas['Telemovel'].map(normalizar_telemovel), "Data": data, "Tipo": tipo,
+        "Valor": valor.fillna(0.0), "Pontos": pd.to_numeric(partes['pts'], errors='coerce').fillna(0).astype(int),
+        "Premio": desc.where(tipo == "Resgate", "").str.replace(r'^Resgate\s*', '', regex=True),
+        "Nota": linhas['Linha'].where(tipo == "Sistema", "")
+    })
+    mov['Mes'] = mov['Data'].dt.to_period('M')
+    return mov.sort_values('Data', kind='stable', na_position='first').reset_index(drop=True)
+
+def resumir_movimentos(antigos):
+    # Agrupa por ano/mês inteiros (agrupar pela coluna Period é muito lento)
+    compra = antigos['Tipo'] == 'Compra'
+    mov = pd.DataFrame({
+        "Cliente": antigos['Cliente'], "Ano": antigos['Data'].dt.year, "MesN": antigos['Data'].dt.month,
+        "Valor": antigos['Valor'].where(compra, 0.0), "Pontos": antigos['Pontos'],
+        "Compras": compra, "Resgates": antigos['Tipo'] == 'Resgate'
+    })
+    r = mov.groupby(['Cliente', 'Ano', 'MesN'], sort=False).agg(
+        Valor=('Valor', 'sum'), Pontos=('Pontos', 'sum'), Compras=('Compras', 'sum'), Resgates=('Resgates', 'sum'), Linhas=('Compras', 'size')
+    ).reset_index()
+    data = pd.to_datetime(pd.DataFrame({"year": r['Ano'], "month": r['MesN'], "day": 1}))
+    nota = (r['Compras'].astype(str) + " compras, " + r['Resgates'].astype(str) + " resgates, "
+            + (r['Linhas'] - r['Compras'] - r['Resgates']).astype(str) + " outros (detalhe no arquivo)")
+    resumo = pd.DataFrame({
+        "Cliente": r['Cliente'], "Data": data, "Tipo": "Resumo", "Valor": r['Valor'].astype(float).round(2),
+        "Pontos": r['Pontos'].astype(int), "Premio": "", "Nota": nota
+    })
+    resumo['Mes'] = resumo['Data'].dt.to_period('M')
+    return resumo
+
+def calcular_resumo(mov, clientes, hoje=None):
+    # Uma passagem vetorizada sobre o livro: gasto por cliente neste mês e no anterior
+    mes = pd.Period(hoje or datetime.now(), 'M')
+    recente = mov[mov['Mes'].isin([mes, mes - 1])]
+    compras = recente[recente['Tipo'] == 'Compra']
+    gasto = compras.pivot_table(index='Cliente', columns='Mes', values='Valor', aggfunc='sum', fill_value=0.0)
+    gasto = gasto.reindex(columns=[mes, mes - 1], fill_value=0.0)
+    gasto.columns = ['Mês actual', 'Mês passado']
+    gasto['Variação'] = gasto['Mês actual'] - gasto['Mês passado']
+    
+    chaves = clientes['Telemovel'].map(normalizar_telemovel)
+    nomes = pd.Series((clientes['Nome'].fillna("") + " " + clientes['Apelido'].fillna("")).values, index=chaves)
+    tipos = pd.Series(clientes['Tipo'].values, index=chaves)
+    nomes = nomes[~nomes.index.duplicated()]
+    tipos = tipos[~tipos.index.duplicated()]
+    gasto.insert(0, 'Nome', gasto.index.map(nomes).fillna(""))
+    gasto.insert(1, 'Tipo', gasto.index.map(tipos).fillna("Normal"))
+    
+    deste_mes = recente[recente['Mes'] == mes]
+    return {
+        "mes": mes,
+        "total": float(gasto['Mês actual'].sum()),
+        "total_anterior": float(gasto['Mês passado'].sum()),
+        "emitidos": int(deste_mes.loc[deste_mes['Pontos'] > 0, 'Pontos'].sum()),
+        "resgatados": int(-deste_mes.loc[deste_mes['Pontos'] < 0, 'Pontos'].sum()),
+        "por_tipo": gasto.groupby('Tipo')[['Mês actual', 'Mês passado']].sum(),
+        "topo": gasto.sort_values('Mês actual', ascending=False).head(10),
+    }
+
+# --- IMPORTAÇÃO DE VENDAS (EXPORTAÇÃO DA CAIXA) ---
+# Colunas reconhecidas no ficheiro da caixa (sem acentos nem maiúsculas)
+COLUNAS_CAIXA = {
+    "Telemovel": ["telemovel", "telefone", "telem", "tel", "phone", "cliente"],
+    "Valor": ["valor", "total", "montante", "amount", "preco"],
+    "Data": ["data", "datahora", "data/hora", "timestamp", "hora", "date"],
+}
+
+def ler_exportacao_caixa(ficheiro):
+    if ficheiro.name.lower().endswith(".xlsx"):
+        try:
+            vendas = pd.read_excel(ficheiro, dtype=str)
+        except ImportError:
+            raise RuntimeError("Para ler XLSX é preciso o pacote openpyxl")
+    else:
+        # Separador detetado automaticamente (a caixa exporta com ";" ou ",")
+        vendas = pd.read_csv(ficheiro, sep=None, engine="python", dtype=str)
+    cabecalho = dict(zip(sem_acentos(pd.Series(vendas.columns)).str.strip(), vendas.columns))
+    colunas = {}
+    for coluna, nomes in COLUNAS_CAIXA.items():
+        original = next((cabecalho[n] for n in nomes if n in cabecalho), None)
+        if original is None: raise ValueError(f"Falta a coluna {coluna} no ficheiro")
+        colunas[original] = coluna
+    return vendas[list(colunas)].rename(columns=colunas)
+
+def preparar_importacao(vendas, df, movimentos=None, indice=None):
+    # Devolve (aceites, rejeitados): tudo em colunas, sem ciclos por linha. movimentos: o livro normalizado
+    v = vendas.copy()
+    v['Linha'] = range(2, len(v) + 2)
+    v['Telemovel'] = v['Telemovel'].fillna("").map(normalizar_telemovel)
+    valor_txt = v['Valor'].fillna("").astype(str).str.replace("€", "").str.strip()
+    # "12,50" e "1.234,50" (formato português) passam a 12.50 e 1234.50
+    valor_txt = valor_txt.where(~valor_txt.str.contains(","), valor_txt.str.replace(".", "").str.replace(",", "."))
+    v['Valor'] = pd.to_numeric(valor_txt, errors='coerce')
+    data_txt = v['Data'].fillna("").astype(str).str.strip()
+    data = pd.to_datetime(data_txt, format="ISO8601", errors='coerce')
+    falhou = data.isna() & (data_txt != "")
+    if falhou.any(): data[falhou] = pd.to_datetime(data_txt[falhou], format='mixed', dayfirst=True, errors='coerce')
+    v['Data'] = data.dt.floor('min')
+    
+    if indice is None: indice = IndiceClientes(df)
+    v['idx'] = v['Telemovel'].map(indice.por_telemovel)
+    
+    motivo = pd.Series("", index=v.index)
+    motivo[v['Valor'].isna() | (v['Valor'] <= 0)] = "Valor inválido"
+    motivo[(motivo == "") & v['Data'].isna()] = "Data inválida"
+    motivo[(motivo == "") & v['idx'].isna()] = "Cliente não encontrado"
+    chave = ['Telemovel', 'Data', 'Valor']
+    motivo[(motivo == "") & v.duplicated(chave)] = "Linha repetida no ficheiro"
+    
+    # Vendas que já estão no livro (o mesmo ficheiro importado duas vezes)
+    if movimentos is not None and len(movimentos):
+        compras = movimentos.loc[movimentos['Tipo'] == 'Compra', ['Cliente', 'Data', 'Valor']].rename(columns={'Cliente': 'Telemovel'}).drop_duplicates()
+        ja = v[chave].merge(compras.assign(_ja=True), on=chave, how='left')['_ja'].fillna(False).to_numpy(dtype=bool)
+        motivo[(motivo == "") & ja] = "Já importada"
+    
+    rejeitados = vendas.assign(Linha=v['Linha'], Motivo=motivo)[motivo != ""]
+    aceites = v[motivo == ""].copy()
+    aceites['idx'] = aceites['idx'].astype(int)
+    aceites['Nome'] = (df['Nome'] + " " + df['Apelido']).reindex(aceites['idx']).to_numpy()
+    aceites['Tipo'] = df['Tipo'].reindex(aceites['idx']).to_numpy()
+    aceites['Pontos'] = calcular_pontos_ganhos_lote(aceites['Valor'], aceites['Tipo'])
+    return aceites[['Linha', 'Telemovel', 'Nome', 'Tipo', 'Data', 'Valor', 'Pontos', 'idx']], rejeitados
+
+def movimentos_importacao(aceites):
+    return pd.DataFrame({
+        "Cliente": aceites['Telemovel'], "Data": aceites['Data'], "Tipo": "Compra", "Valor": aceites['Valor'].astype(float),
+        "Pontos": aceites['Pontos'].astype(int), "Premio": "", "Nota": "Importação da caixa"
+    })
+
+# --- TABELA E EXPORTAÇÃO DE CLIENTES ---
+CSV_BLOCO = 5000
+COLUNAS_EXPORTACAO = [c for c in COLUNAS_CLIENTES if c not in ("Password", "Historico")]
+
+def filtrar_tabela(df, tipos=None, localidades=None, pontos=None, ordem=None, ascendente=True):
+    # Devolve só os rótulos das linhas (sem copiar o DataFrame)
+    mascara = pd.Series(True, index=df.index)
+    if tipos: mascara &= df['Tipo'].isin(tipos)
+    if localidades: mascara &= df['Localidade'].isin(localidades)
+    if pontos: mascara &= df['Pontos'].between(*pontos)
+    if not ordem: return df.index[mascara]
+    return df.loc[mascara, ordem].sort_values(ascending=ascendente, kind='stable').index
+
+def exportar_csv(df, linhas, colunas):
+    # Escrito aos blocos, só quando o botão é carregado
+    buf = io.StringIO()
+    for i in range(0, len(linhas), CSV_BLOCO):
+        df.loc[linhas[i:i + CSV_BLOCO], colunas].to_csv(buf, index=False, header=(i == 0))
+    return buf.getvalue().encode("utf-8-sig")
+
+# --- LEITURAS DO SHEETS (UMA SÓ EM VOO, NOVAS TENTATIVAS NA QUOTA) ---
+def erro_quota(e):
+    # Só o estado HTTP: o texto de outros erros pode ter "429" (uma linha, um telemóvel)
+    return getattr(getattr(e, 'response', None), 'status_code', None) == 429
+
+def _copia_leitura(resultado):
+    # Cada sessão recebe a sua cópia (quem lê normaliza o DataFrame no sítio)
+    if isinstance(resultado, (pd.DataFrame, pd.Series)): return resultado.copy()
+    if isinstance(resultado, list): return list(resultado)
+    return resultado
+
+class LeiturasPartilhadas:
+    def __init__(self, tentativas=4, espera_base=1.0):
+        self.tentativas = tentativas
+        self.espera_base = espera_base
+        self.lock = threading.Lock()
+        self.em_voo = {}
+        self.leituras = 0
+        self.partilhadas = 0
+        self.repetidas = 0
+        self.desistencias = 0
+
+    def ler(self, chave, funcao):
+        with self.lock:
+            voo = self.em_voo.get(chave)
+            lider = voo is None
+            if lider:
+                voo = self.em_voo[chave] = {"feito": threading.Event(), "resultado": None, "erro": None}
+                self.leituras += 1
+            else:
+                self.partilhadas += 1
+        if not lider:
+            voo["feito"].wait()
+            if voo["erro"] is not None: raise voo["erro"]
+            return _copia_leitura(voo["resultado"])
+        try:
+            voo["resultado"] = self._com_tentativas(funcao)
+            return _copia_leitura(voo["resultado"])
+        except Exception as e:
+            voo["erro"] = e
+            raise
+        finally:
+            with self.lock: self.em_voo.pop(chave, None)
+            voo["feito"].set()
+
+    def _com_tentativas(self, funcao):
+        for tentativa in range(self.tentativas):
+            try:
+                return funcao()
+            except Exception as e:
+                if not erro_quota(e): raise
+                if tentativa == self.tentativas - 1:
+                    with self.lock: self.desistencias += 1
+                    raise
+                with self.lock: self.repetidas += 1
+                espera = self.espera_base * 2 ** tentativa
+                time.sleep(espera / 2 + random.uniform(0, espera / 2))
+
+# --- ARMAZENAMENTO (GOOGLE SHEETS OU SQLITE LOCAL) ---
+# Os índices (idx) das linhas são sempre os do DataFrame devolvido por ler_clientes.
+# O gspread só é importado quando o motor do Sheets é usado (as tarefas em SQLite passam sem ele).
+FOLHA_CLIENTES = "Sheet1"
+
+def _esquecer_folhas(metodo):
+    # Folha apagada ou renomeada noutro lado: os handles guardados deixam de servir e a próxima chamada reabre-os
+    @functools.wraps(metodo)
+    def envolvido(self, *args, **kwargs):
+        try:
+            return metodo(self, *args, **kwargs)
+        except Exception as e:
+            if type(e).__name__ == "WorksheetNotFound" or getattr(getattr(e, 'response', None), 'status_code', None) == 404:
+                self.folhas.clear()
+            raise
+    return envolvido
+
+class Armazenamento(ABC):
+    # Um motor a que falte um método falha ao ser criado, não a meio de um lançamento
+    nome = ""
+
+    @abstractmethod
+    def ler_clientes(self): ...
+
+    @abstractmethod
+    def ler_colunas(self, colunas): ...
+
+    @abstractmethod
+    def obter_cliente(self, telemovel): ...
+
+    @abstractmethod
+    def inserir_cliente(self, registo): ...
+
+    @abstractmethod
+    def atualizar_campos(self, alteracoes, telemoveis): ...
+
+    @abstractmethod
+    def apagar_cliente(self, idx, telemovel): ...
+
+    @abstractmethod
+    def ler_pontos(self, idx, telemovel): ...
+
+    @abstractmethod
+    def cas_pontos(self, idx, telemovel, esperado, novo): ...
+
+    @abstractmethod
+    def reescrever_clientes(self, df): ...
+
+    @abstractmethod
+    def ler_movimentos(self): ...
+
+    @abstractmethod
+    def acrescentar_movimentos(self, mov): ...
+
+    @abstractmethod
+    def renomear_movimentos(self, antigo, novo, posicoes): ...
+
+    @abstractmethod
+    def reescrever_movimentos(self, mov): ...
+
+    @abstractmethod
+    def ler_arquivo(self, cliente): ...
+
+    @abstractmethod
+    def acrescentar_arquivo(self, mov): ...
+
+class ArmazenamentoSheets(Armazenamento):
+    nome = "gsheets"
+
+    def __init__(self, ligacao, folhas=None, leituras=None):
+        # folhas: a secção [lojas.<nome>] da configuração (o que faltar usa as folhas de sempre); leituras: partilhadas entre sessões
+        folhas = folhas or {}
+        self.conn = ligacao
+        self.colunas = None
+        self.folha_clientes = folhas.get("clientes", FOLHA_CLIENTES)
+        self.folha_movimentos = folhas.get("movimentos", FOLHA_MOVIMENTOS)
+        self.folha_arquivo = folhas.get("arquivo", FOLHA_ARQUIVO)
+        self.leituras = leituras or LeiturasPartilhadas()
+        # Worksheet gspread por nome: abrir uma custa duas leituras de metadados (livro e folha) à quota
+        self.folhas = {}
+
+    def _folha(self, nome=None):
+        # Só disponível com Service Account; a ligação pública não tem worksheet gspread
+        nome = nome or self.folha_clientes
+        ws = self.folhas.get(nome)
+        if ws is None: ws = self.folhas[nome] = self.conn.client._select_worksheet(worksheet=nome)
+        return ws
+
+    def _ler(self, *chave, funcao):
+        return self.leituras.ler(chave, funcao)
+
+    def _linhas(self, ws, telemoveis):
+        # O idx corresponde à linha da folha (cabeçalho na linha 1).
+        # Confirma os telemóveis antes de escrever para nunca tocar na linha errada.
+        if self.colunas is None: raise LookupError("Cabeçalho desconhecido")
+        col_tel = self.colunas.index('Telemovel') + 1
+        linhas = {i: int(i) + 2 for i in telemoveis}
+        if len(linhas) == 1:
+            na_folha = {l: ws.cell(l, col_tel).value for l in linhas.values()}
+        else:
+            coluna = ws.col_values(col_tel)
+            na_folha = {l: coluna[l - 1] if l <= len(coluna) else "" for l in linhas.values()}
+        for i, l in linhas.items():
+            if normalizar_telemovel(na_folha[l]) != normalizar_telemovel(telemoveis[i]):
+                raise LookupError(f"Linha {l} não corresponde ao cliente")
+        return linhas
+
+    def ler_clientes(self):
+        df = self._ler("read", self.folha_clientes, funcao=lambda: self.conn.read(worksheet=self.folha_clientes, ttl=0))
+        if df is None or df.empty: return pd.DataFrame(columns=COLUNAS_CLIENTES)
+        self.colunas = list(df.columns)
+        return df
+
+    @_esquecer_folhas
+    def ler_colunas(self, colunas):
+        # Só as colunas pedidas, num batch_get; sem Service Account lê a folha toda e projeta
+        from gspread.exceptions import WorksheetNotFound
+        try:
+            ws = self._folha()
+        except WorksheetNotFound:
+            raise
+        except Exception:
+            df = self.ler_clientes()
+            return df[[c for c in colunas if c in df.columns]]
+        self.colunas, df = self._ler("colunas", self.folha_clientes, tuple(colunas), funcao=lambda: self._projetar(ws, colunas))
+        return df.copy()
+
+    def _projetar(self, ws, colunas):
+        from gspread.utils import rowcol_to_a1
+        cabecalho = ws.row_values(1)
+        presentes = [c for c in colunas if c in cabecalho]
+        letras = [rowcol_to_a1(1, cabecalho.index(c) + 1)[:-1] for c in presentes]
+        blocos = [b[0] if b else [] for b in ws.batch_get([f"{l}2:{l}" for l in letras], major_dimension="COLUMNS")]
+        # A API corta as células vazias no fim de cada coluna; a linha i da folha é sempre o idx i - 2
+        n = max(map(len, blocos), default=0)
+        return cabecalho, pd.DataFrame({c: b + [""] * (n - len(b)) for c, b in zip(presentes, blocos)}, index=range(n))
+
+    @_esquecer_folhas
+    def obter_cliente(self, telemovel):
+        ws = self._folha()
+        if self.colunas is None: self.colunas = self._ler("linha", self.folha_clientes, 1, funcao=lambda: ws.row_values(1))
+        # Só a coluna dos telemóveis e depois a linha do cliente (o find do gspread descarrega a folha toda)
+        col_tel = self.colunas.index('Telemovel') + 1
+        coluna = self._ler("coluna", self.folha_clientes, col_tel, funcao=lambda: ws.col_values(col_tel))
+        tel = normalizar_telemovel(telemovel)
+        linha = next((i + 1 for i, v in enumerate(coluna[1:], start=1) if normalizar_telemovel(v) == tel), None)
+        if linha is None: return None
+        valores = self._ler("linha", self.folha_clientes, linha, funcao=lambda: ws.row_values(linha))
+        return pd.Series(dict(zip(self.colunas, valores + [""] * (len(self.colunas) - len(valores)))), name=linha - 2)
+
+    @_esquecer_folhas
+    def inserir_cliente(self, registo):
+        ws = self._folha()
+        if not self.colunas: self.colunas = self._ler("linha", self.folha_clientes, 1, funcao=lambda: ws.row_values(1))
+        ws.append_rows([[valor_celula(registo.get(c, "")) for c in self.colunas]], value_input_option="USER_ENTERED")
+
+    @_esquecer_folhas
+    def atualizar_campos(self, alteracoes, telemoveis):
+        from gspread import Cell
+        ws = self._folha()
+        linhas = self._linhas(ws, telemoveis)
+        celulas = [Cell(linhas[i], self.colunas.index(c) + 1, valor_celula(v)) for i, campos in alteracoes.items() for c, v in campos.items()]
+        ws.update_cells(celulas, value_input_option="USER_ENTERED")
+
+    @_esquecer_folhas
+    def apagar_cliente(self, idx, telemovel):
+        ws = self._folha()
+        ws.delete_rows(self._linhas(ws, {idx: telemovel})[idx])
+
+    def _pontos_na_folha(self, ws, idx, telemovel):
+        # Lê a linha inteira numa chamada: confirma o cliente e devolve o saldo atual
+        if self.colunas is None: raise LookupError("Cabeçalho desconhecido")
+        valores = ws.row_values(int(idx) + 2) + [""] * len(self.colunas)
+        if normalizar_telemovel(valores[self.colunas.index('Telemovel')]) != normalizar_telemovel(telemovel):
+            raise LookupError(f"Linha {int(idx) + 2} não corresponde ao cliente")
+        return int(float(valores[self.colunas.index('Pontos')] or 0))
+
+    @_esquecer_folhas
+    def ler_pontos(self, idx, telemovel):
+        return self._pontos_na_folha(self._folha(), idx, telemovel)
+
+    @_esquecer_folhas
+    def cas_pontos(self, idx, telemovel, esperado, novo):
+        # O Sheets não tem escrita condicional: compara e escreve com o trinco do cliente na mão
+        from gspread import Cell
+        ws = self._folha()
+        if self._pontos_na_folha(ws, idx, telemovel) != esperado: return False
+        ws.update_cells([Cell(int(idx) + 2, self.colunas.index('Pontos') + 1, int(novo))], value_input_option="USER_ENTERED")
+        return True
+
+    def reescrever_clientes(self, df):
+        self.conn.update(worksheet=self.folha_clientes, data=df)
+        self.colunas = list(df.columns)
+        # Depois da reescrita as linhas ficam contíguas, por isso o índice volta a 0..n-1
+        return df.reset_index(drop=True)
+
+    def ler_movimentos(self):
+        # None só sem a folha (livro por migrar); uma folha só com o cabeçalho é um livro sem movimentos
+        from gspread.exceptions import WorksheetNotFound
+        try:
+            raw = self._ler("read", self.folha_movimentos, funcao=lambda: self.conn.read(worksheet=self.folha_movimentos, ttl=0))
+        except WorksheetNotFound:
+            return None
+        return pd.DataFrame(columns=COLUNAS_MOVIMENTOS) if raw is None else raw
+
+    @_esquecer_folhas
+    def acrescentar_movimentos(self, mov):
+        self._folha(self.folha_movimentos).append_rows(linhas_movimentos(mov), value_input_option="RAW")
+
+    @_esquecer_folhas
+    def renomear_movimentos(self, antigo, novo, posicoes):
+        from gspread import Cell
+        col = COLUNAS_MOVIMENTOS.index('Cliente') + 1
+        self._folha(self.folha_movimentos).update_cells([Cell(int(p) + 2, col, normalizar_telemovel(novo)) for p in posicoes], value_input_option="RAW")
+
+    @_esquecer_folhas
+    def reescrever_movimentos(self, mov):
+        # Nunca limpa a folha antes de escrever: uma falha a meio deixa o livro anterior inteiro.
+        # Um livro vazio seria lido como um livro sem movimentos (a migração só corre sem a folha).
+        from gspread.exceptions import WorksheetNotFound
+        linhas = [COLUNAS_MOVIMENTOS] + linhas_movimentos(mov)
+        try:
+            ws = self._folha(self.folha_movimentos)
+        except WorksheetNotFound:
+            self._criar_folha(self.folha_movimentos, linhas)
+            return
+        # Uma só escrita por cima do livro antigo, com as linhas que sobram em branco
+        if ws.row_count < len(linhas): ws.add_rows(len(linhas) - ws.row_count)
+        vazias = [[""] * len(COLUNAS_MOVIMENTOS)] * (ws.row_count - len(linhas))
+        ws.update(range_name="A1", values=linhas + vazias, value_input_option="RAW")
+        try:
+            # Cortar as linhas em branco do fim é só arrumação
+            ws.resize(rows=len(linhas) + 1)
+        except Exception:
+            pass
+
+    def _criar_folha(self, nome, linhas):
+        # Enchida com um nome provisório e só depois renomeada: até lá ninguém a lê como livro
+        from gspread.exceptions import WorksheetNotFound
+        livro = self.conn.client._open_spreadsheet()
+        provisoria = f"{nome} (a criar)"
+        try:
+            livro.del_worksheet(self._folha(provisoria))
+        except WorksheetNotFound:
+            pass
+        self.folhas.pop(provisoria, None)
+        ws = livro.add_worksheet(title=provisoria, rows=max(len(linhas) + 1, 100), cols=len(COLUNAS_MOVIMENTOS))
+        ws.append_rows(linhas, value_input_option="RAW")
+        ws.update_title(nome)
+        self.folhas[nome] = ws
+
+    def ler_arquivo(self, cliente):
+        # Só a pedido: a folha de arquivo não entra nas leituras normais
+        from gspread.exceptions import WorksheetNotFound
+        try:
+            raw = self._ler("read", self.folha_arquivo, funcao=lambda: self.conn.read(worksheet=self.folha_arquivo, ttl=0))
+        except WorksheetNotFound:
+            return None
+        if raw is None or raw.empty: return None
+        raw = raw[raw['Cliente'].fillna("").map(normalizar_telemovel) == normalizar_telemovel(cliente)]
+        return None if raw.empty else raw
+
+    @_esquecer_folhas
+    def acrescentar_arquivo(self, mov):
+        from gspread.exceptions import WorksheetNotFound
+        try:
+            ws = self._folha(self.folha_arquivo)
+            linhas = linhas_movimentos(mov)
+        except WorksheetNotFound:
+            ws = self.folhas[self.folha_arquivo] = self.conn.client._open_spreadsheet().add_worksheet(title=self.folha_arquivo, rows=max(len(mov) + 1, 100), cols=len(COLUNAS_MOVIMENTOS))
+            linhas = [COLUNAS_MOVIMENTOS] + linhas_movimentos(mov)
+        ws.append_rows(linhas, value_input_option="RAW")
+
+ESQUEMA_SQLITE = """
+CREATE TABLE IF NOT EXISTS clientes (
+    id INTEGER PRIMARY KEY,
+    Telemovel TEXT NOT NULL, Nome TEXT, Apelido TEXT, Email TEXT, Pontos INTEGER NOT NULL DEFAULT 0,
+    Historico TEXT, Password TEXT, Tipo TEXT, Idade INTEGER NOT NULL DEFAULT 0, Nascimento TEXT,
+    ComidaFavorita TEXT, Localidade TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_clientes_telemovel ON clientes(Telemovel);
+CREATE INDEX IF NOT EXISTS idx_clientes_email ON clientes(lower(Email));
+CREATE TABLE IF NOT EXISTS movimentos (
+    id INTEGER PRIMARY KEY,
+    Cliente TEXT NOT NULL, Data TEXT, Tipo TEXT, Valor REAL NOT NULL DEFAULT 0, Pontos INTEGER NOT NULL DEFAULT 0,
+    Premio TEXT, Nota TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_movimentos_cliente_data ON movimentos(Cliente, Data);
+CREATE TABLE IF NOT EXISTS arquivo (
+    id INTEGER PRIMARY KEY,
+    Cliente TEXT NOT NULL, Data TEXT, Tipo TEXT, Valor REAL NOT NULL DEFAULT 0, Pontos INTEGER NOT NULL DEFAULT 0,
+    Premio TEXT, Nota TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_arquivo_cliente ON arquivo(Cliente);
+CREATE TABLE IF NOT EXISTS estado (chave TEXT PRIMARY KEY, valor TEXT);
+"""
+
+class ArmazenamentoSQLite(Armazenamento):
+    nome = "sqlite"
+
+    def __init__(self, caminho, criar=True):
+        # criar=False: só abre uma base que já existe (consultar outra loja não deixa ficheiros vazios)
+        if not criar and not os.path.exists(caminho): raise FileNotFoundError(f"Base de dados não encontrada: {caminho}")
+        self.caminho = caminho
+        with self._transacao() as con:
+            con.executescript(ESQUEMA_SQLITE)
+
+    @contextmanager
+    def _transacao(self):
+        # Uma ligação por operação; "with con" faz commit ou rollback
+        con = sqlite3.connect(self.caminho, timeout=30)
+        try:
+            with con: yield con
+        finally:
+            con.close()
+
+    def _registo(self, registo):
+        valores = {c: valor_celula(registo.get(c, "")) for c in COLUNAS_CLIENTES if c in registo}
+        if 'Telemovel' in valores: valores['Telemovel'] = normalizar_telemovel(valores['Telemovel'])
+        return valores
+
+    def ler_clientes(self):
+        with self._transacao() as con:
+            df = pd.read_sql_query(f"SELECT id, {', '.join(COLUNAS_CLIENTES)} FROM clientes ORDER BY id", con, index_col="id")
+        df.index.name = None
+        return df
+
+    def ler_colunas(self, colunas):
+        with self._transacao() as con:
+            df = pd.read_sql_query(f"SELECT id, {', '.join(c for c in colunas if c in COLUNAS_CLIENTES)} FROM clientes ORDER BY id", con, index_col="id")
+        df.index.name = None
+        return df
+
+    def obter_cliente(self, telemovel):
+        with self._transacao() as con:
+            df = pd.read_sql_query(f"SELECT id, {', '.join(COLUNAS_CLIENTES)} FROM clientes WHERE Telemovel = ? ORDER BY id LIMIT 1", con, params=(normalizar_telemovel(telemovel),), index_col="id")
+        return None if df.empty else df.iloc[0]
+
+    def inserir_cliente(self, registo):
+        valores = self._registo(registo)
+        with self._transacao() as con:
+            con.execute(f"INSERT INTO clientes ({', '.join(valores)}) VALUES ({', '.join('?' * len(valores))})", list(valores.values()))
+
+    def atualizar_campos(self, alteracoes, telemoveis):
+        with self._transacao() as con:
+            for idx, campos in alteracoes.items():
+                valores = self._registo(campos)
+                con.execute(f"UPDATE clientes SET {', '.join(f'{c} = ?' for c in valores)} WHERE id = ?", [*valores.values(), int(idx)])
+
+    def apagar_cliente(self, idx, telemovel):
+        with self._transacao() as con:
+            con.execute("DELETE FROM clientes WHERE id = ?", (int(idx),))
+
+    def ler_pontos(self, idx, telemovel):
+        with self._transacao() as con:
+            linha = con.execute("SELECT Pontos FROM clientes WHERE id = ? AND Telemovel = ?", (int(idx), normalizar_telemovel(telemovel))).fetchone()
+        if linha is None: raise LookupError("Cliente não encontrado")
+        return int(linha[0])
+
+    def cas_pontos(self, idx, telemovel, esperado, novo):
+        # Compare-and-swap atómico, também entre processos
+        with self._transacao() as con:
+            cur = con.execute("UPDATE clientes SET Pontos = ? WHERE id = ? AND Telemovel = ? AND Pontos = ?", (int(novo), int(idx), normalizar_telemovel(telemovel), int(esperado)))
+        return cur.rowcount == 1
+
+    def reescrever_clientes(self, df):
+        df = df.reset_index(drop=True)
+        with self._transacao() as con:
+            con.execute("DELETE FROM clientes")
+            con.executemany(
+                f"INSERT INTO clientes (id, {', '.join(COLUNAS_CLIENTES)}) VALUES ({', '.join('?' * (len(COLUNAS_CLIENTES) + 1))})",
+                [[i, *self._registo(r).values()] for i, r in zip(df.index, df[COLUNAS_CLIENTES].to_dict('records'))]
+            )
+        return df
+
+    def _marcar_livro(self, con):
+        # A tabela existe sempre (esquema): a migração do Historico fica marcada em estado
+        con.execute("INSERT OR IGNORE INTO estado (chave, valor) VALUES ('livro_movimentos', ?)", (datetime.now().isoformat(timespec="seconds"),))
+
+    def ler_movimentos(self):
+        with self._transacao() as con:
+            raw = pd.read_sql_query(f"SELECT {', '.join(COLUNAS_MOVIMENTOS)} FROM movimentos ORDER BY id", con)
+            # Bases anteriores à marca: um livro com linhas também já foi migrado
+            migrado = len(raw) or con.execute("SELECT 1 FROM estado WHERE chave = 'livro_movimentos'").fetchone()
+        return raw if migrado else None
+
+    def acrescentar_movimentos(self, mov):
+        with self._transacao() as con:
+            self._marcar_livro(con)
+            con.executemany(f"INSERT INTO movimentos ({', '.join(COLUNAS_MOVIMENTOS)}) VALUES ({', '.join('?' * len(COLUNAS_MOVIMENTOS))})", linhas_movimentos(mov))
+
+    def renomear_movimentos(self, antigo, novo, posicoes):
+        with self._transacao() as con:
+            con.execute("UPDATE movimentos SET Cliente = ? WHERE Cliente = ?", (normalizar_telemovel(novo), normalizar_telemovel(antigo)))
+
+    def reescrever_movimentos(self, mov):
+        with self._transacao() as con:
+            self._marcar_livro(con)
+            con.execute("DELETE FROM movimentos")
+            con.executemany(f"INSERT INTO movimentos ({', '.join(COLUNAS_MOVIMENTOS)}) VALUES ({', '.join('?' * len(COLUNAS_MOVIMENTOS))})", linhas_movimentos(mov))
+
+    def ler_arquivo(self, cliente):
+        with self._transacao() as con:
+            raw = pd.read_sql_query(f"SELECT {', '.join(COLUNAS_MOVIMENTOS)} FROM arquivo WHERE Cliente = ? ORDER BY id", con, params=(normalizar_telemovel(cliente),))
+        return None if raw.empty else raw
+
+    def acrescentar_arquivo(self, mov):
+        with self._transacao() as con:
+            con.executemany(f"INSERT INTO arquivo ({', '.join(COLUNAS_MOVIMENTOS)}) VALUES ({', '.join('?' * len(COLUNAS_MOVIMENTOS))})", linhas_movimentos(mov))
\ No newline at end of file
@@ -0,0 +1,152 @@
+# Tarefas sem interface, para o cron: as regras e os motores de nucleo.py, sem Streamlit.
+#
+#   python tarefas.py manutencao                          # idades e estudantes que passam a Normal
+#   python tarefas.py importar vendas.xlsx --simular      # pontos das vendas da caixa (sem escrever)
+#   python tarefas.py exportar clientes clientes.csv --tipo Estudante
+#   python tarefas.py exportar movimentos movimentos.csv
+#
+# Lê a configuração da app (.streamlit/secrets.toml): armazenamento, loja, lojas e [connections.gsheets].
+# Escreve diretamente no armazenamento: correr fora do horário, com a fila de escrita da app vazia.
+import argparse
+import os
+import sys
+import time
+import tomllib
+from datetime import date
+
+import pandas as pd
+
+from nucleo import (
+    COLUNAS_CLIENTES, COLUNAS_EXPORTACAO, COLUNAS_MOVIMENTOS, FORMATO_DATA_MOVIMENTO, ArmazenamentoSheets,
+    ArmazenamentoSQLite, alteracoes_manutencao, converter_historico, exportar_csv, filtrar_tabela, ler_exportacao_caixa,
+    movimentos_importacao, normalizar_clientes, normalizar_movimentos, novo_movimento, preparar_importacao, somar_pontos
+)
+
+# Os mesmos ficheiros que o st.secrets, pela mesma ordem (o do projeto ganha)
+SECRETS = [os.path.expanduser("~/.streamlit/secrets.toml"), os.path.join(".streamlit", "secrets.toml")]
+
+def ler_configuracao():
+    cfg = {}
+    for caminho in SECRETS:
+        if os.path.exists(caminho):
+            with open(caminho, "rb") as f: cfg.update(tomllib.load(f))
+    return cfg
+
+def abrir_armazenamento(cfg, loja):
+    lojas = cfg.get("lojas", {})
+    if cfg.get("armazenamento", "gsheets") == "sqlite":
+        # Como na app: só a loja principal usa (e cria) a base por omissão; as outras têm de estar configuradas
+        principal = loja == cfg.get("loja", "principal")
+        caminho = lojas.get(loja, {}).get("sqlite_caminho", cfg.get("sqlite_caminho", "kaokente.db") if principal else None)
+        if not caminho: raise LookupError(f"Loja {loja} sem sqlite_caminho na configuração")
+        return ArmazenamentoSQLite(caminho, criar=principal)
+    # A ligação ao Sheets é a da app (streamlit-gsheets); só este caminho importa o streamlit
+    import streamlit as st
+    from streamlit import logger
+    from streamlit_gsheets import GSheetsConnection
+    # Sem servidor o st.connection avisa que não há ScriptRunContext
+    logger.set_log_level("error")
+    return ArmazenamentoSheets(st.connection("gsheets", type=GSheetsConnection), lojas.get(loja))
+
+def fila_da_app(cfg, loja):
+    # O spool da fila de escrita diferida da app para esta loja (None sem fila: SQLite ou escrita_diferida = false)
+    if cfg.get("armazenamento", "gsheets") == "sqlite" or not cfg.get("escrita_diferida", True): return None
+    if loja == cfg.get("loja", "principal") and cfg.get("fila_spool"): return cfg["fila_spool"]
+    return f"fila_escritas_{loja}.json"
+
+def ler_livro(motor, escrever=True):
+    # Como na app: se o livro ainda não existe, a primeira leitura passa para lá o Historico de texto
+    raw = motor.ler_movimentos()
+    if raw is not None: return normalizar_movimentos(raw)
+    mov = converter_historico(normalizar_clientes(motor.ler_clientes()))
+    if escrever: motor.reescrever_movimentos(mov)
+    return mov
+
+# --- TAREFAS ---
+def manutencao(motor, a):
+    df = normalizar_clientes(motor.ler_clientes())
+    alteracoes, migrados = alteracoes_manutencao(df, a.data)
+    if alteracoes and not a.simular:
+        motor.atualizar_campos(alteracoes, {i: df.at[i, 'Telemovel'] for i in alteracoes})
+        if migrados:
+            ler_livro(motor)
+            motor.acrescentar_movimentos(pd.DataFrame([novo_movimento(t, "Sistema", nota="Mudou para Normal (>19 anos)") for t in migrados]))
+    idades = sum('Idade' in campos for campos in alteracoes.values())
+    print(f"{len(df)} clientes · {idades} idades atualizadas · {len(migrados)} passaram a Normal")
+
+def importar(motor, a):
+    with open(a.ficheiro, "rb") as f:
+        vendas = ler_exportacao_caixa(f)
+    df = normalizar_clientes(motor.ler_clientes())
+    aceites, rejeitados = preparar_importacao(vendas, df, ler_livro(motor, escrever=not a.simular))
+    if a.rejeitados and len(rejeitados): rejeitados.to_csv(a.rejeitados, index=False, encoding="utf-8-sig")
+    por_cliente = aceites.groupby('idx')['Pontos'].sum()
+    if len(aceites) and not a.simular:
+        # Cada saldo somado com compare-and-swap, como na app sem a fila. A fila da app escreve saldos absolutos
+        # do seu snapshot e apagaria estes: com ela, só fora do horário e com a fila vazia (ver main)
+        falhas = []
+        for i, p in por_cliente.items():
+            try:
+                somar_pontos(motor, i, df.at[i, 'Telemovel'], int(p))
+            except Exception as e:
+                falhas.append(i)
+                print(f"{df.at[i, 'Telemovel']}: {e}", file=sys.stderr)
+        # Só os movimentos de quem recebeu os pontos: correr outra vez trata do resto
+        aceites, por_cliente = aceites[~aceites['idx'].isin(falhas)], por_cliente.drop(falhas)
+        motor.acrescentar_movimentos(movimentos_importacao(aceites))
+    print(f"{len(aceites)} vendas aceites · {len(rejeitados)} rejeitadas · {int(por_cliente.sum())} pontos para {len(por_cliente)} clientes")
+
+def exportar(motor, a):
+    if a.dados == "movimentos":
+        mov = ler_livro(motor, escrever=False)
+        dados, n = mov[COLUNAS_MOVIMENTOS].to_csv(index=False, date_format=FORMATO_DATA_MOVIMENTO).encode("utf-8-sig"), len(mov)
+    else:
+        df = normalizar_clientes(motor.ler_clientes())
+        linhas = filtrar_tabela(df, a.tipo, a.localidade, None, a.ordem)
+        dados, n = exportar_csv(df, linhas, a.colunas or COLUNAS_EXPORTACAO), len(linhas)
+    with open(a.ficheiro, "wb") as f:
+        f.write(dados)
+    print(f"{n} linhas em {a.ficheiro}")
+
+TAREFAS = {"manutencao": manutencao, "importar": importar, "exportar": exportar}
+
+def main():
+    p = argparse.ArgumentParser(description="Tarefas da app de fidelidade sem interface (cron)")
+    p.add_argument("--loja", help="loja a tratar (por omissão a da configuração)")
+    sub = p.add_subparsers(dest="tarefa", required=True)
+
+    m = sub.add_parser("manutencao", help="atualiza idades e passa a Normal os estudantes com mais de 19 anos")
+    m.add_argument("--data", type=date.fromisoformat, help="dia de referência AAAA-MM-DD (por omissão hoje)")
+    m.add_argument("--simular", action="store_true", help="só mostra o que mudava")
+
+    i = sub.add_parser("importar", help="lança os pontos das vendas exportadas da caixa (CSV ou XLSX)")
+    i.add_argument("ficheiro")
+    i.add_argument("--rejeitados", help="CSV com as linhas rejeitadas e o motivo")
+    i.add_argument("--simular", action="store_true", help="só valida o ficheiro")
+
+    e = sub.add_parser("exportar", help="exporta clientes ou movimentos para CSV")
+    e.add_argument("dados", choices=["clientes", "movimentos"])
+    e.add_argument("ficheiro")
+    e.add_argument("--colunas", nargs="+", choices=COLUNAS_CLIENTES, help="colunas dos clientes (por omissão sem Password nem Historico)")
+    e.add_argument("--tipo", nargs="+", help="só estes tipos de cliente")
+    e.add_argument("--localidade", nargs="+", help="só estas localidades")
+    e.add_argument("--ordem", choices=COLUNAS_CLIENTES, help="coluna de ordenação")
+    a = p.parse_args()
+
+    cfg = ler_configuracao()
+    loja = a.loja or cfg.get("loja", "principal")
+    spool = fila_da_app(cfg, loja)
+    if a.tarefa == "importar" and not a.simular and spool and os.path.exists(spool):
+        print(f"Erro: a fila de escrita da app tem alterações por enviar ({spool}); esperar que esvazie", file=sys.stderr)
+        return 1
+    t0 = time.perf_counter()
+    try:
+        TAREFAS[a.tarefa](abrir_armazenamento(cfg, loja), a)
+    except Exception as e:
+        print(f"Erro: {e}", file=sys.stderr)
+        return 1
+    print(f"Feito em {time.perf_counter() - t0:.1f} s")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
\ No newline at end of file